@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+"""
+batch.py - Copyright (c) 2012, Howard C. Shaw III
+Licensed under the GNU GPL v3
+
+batch.py [options] manifest-or-directory ...
+
+Run detangle.py on many datasets at once, on a pool of worker processes. Each worker is
+started once and then takes datasets one at a time, so that the process startup is paid per
+worker rather than per dataset, and a dataset that fails (an unreadable file, a tree that will
+not parse) is reported as failed without stopping the others.
+
+A dataset is either listed in a manifest, one per line:
+
+name file [file ...] [seed=N] [time-limit=SECONDS] [output=FILE]
+
+(files relative to the manifest; blank lines and lines starting with # are skipped), or found
+in a directory: every tree file in it is a dataset named after the file, and every
+subdirectory a dataset of all the tree files it holds.
+
+The result of each dataset is written to <output directory>/<name>.dat unless the manifest
+says otherwise, and a table of every dataset (status, number of trees, seed, starting and
+final score, seconds taken and error) is written to <output directory>/summary.tsv and printed.
+"""
+
+from detangle import read_trees, compact_tree, taxon_table, minimize_this, process_trees, \
+    add_objective_arguments, objective_options, add_search_arguments, search_options
+import os
+import time
+import random
+import argparse
+import traceback
+import multiprocessing
+
+""" Tweak these values to change behavior:
+
+Jobs = the number of worker processes (one per CPU by default)
+Output Directory = where the result of every dataset and the summary table are written
+Summary Filename = the name of the summary table in the output directory
+Extensions = the tree files picked up from a directory
+"""
+
+g_jobs = multiprocessing.cpu_count()
+g_output_directory = 'results'
+g_summary_filename = 'summary.tsv'
+g_extensions = ('.tre', '.tree', '.trees', '.nex', '.nexus', '.nwk', '.newick', '.dat')
+
+g_columns = ['name', 'status', 'trees', 'seed', 'start', 'best', 'seconds', 'output', 'error']
+
+def read_manifest(filename):
+    """ The datasets listed in a manifest, as dicts of name, infiles and, when given,
+    seed, time_limit and output """
+    directory = os.path.dirname(filename)
+    datasets = []
+    with open(filename, 'r') as f:
+        for (number, line) in enumerate(f):
+            words = line.split()
+            if len(words) == 0 or words[0].startswith('#'):
+                continue
+            dataset = {'name': words[0], 'infiles': []}
+            for word in words[1:]:
+                if '=' in word:
+                    (key, value) = word.split('=', 1)
+                    if key == 'seed':
+                        dataset['seed'] = int(value)
+                    elif key == 'time-limit':
+                        dataset['time_limit'] = float(value)
+                    elif key == 'output':
+                        dataset['output'] = value
+                    else:
+                        raise ValueError(filename + ", line " + str(number + 1) +
+                            ": unknown setting " + key)
+                else:
+                    dataset['infiles'].append(os.path.join(directory, word))
+            if len(dataset['infiles']) == 0:
+                raise ValueError(filename + ", line " + str(number + 1) + ": no tree files")
+            datasets.append(dataset)
+    return datasets
+
+def scan_directory(directory, extensions=g_extensions):
+    """ The datasets in a directory: one per tree file, and one per subdirectory
+    holding tree files """
+    def tree_files(path):
+        return [os.path.join(path, x) for x in sorted(os.listdir(path))
+            if os.path.splitext(x)[1].lower() in extensions and os.path.isfile(os.path.join(path, x))]
+    datasets = []
+    for x in sorted(os.listdir(directory)):
+        path = os.path.join(directory, x)
+        if os.path.isdir(path):
+            infiles = tree_files(path)
+            if len(infiles) > 0:
+                datasets.append({'name': x, 'infiles': infiles})
+        elif path in tree_files(directory):
+            datasets.append({'name': os.path.splitext(x)[0], 'infiles': [path]})
+    return datasets
+
+def find_datasets(sources):
+    """ The datasets of a list of manifests and directories, which must have distinct names """
+    datasets = []
+    for source in sources:
+        if os.path.isdir(source):
+            datasets.extend(scan_directory(source))
+        else:
+            datasets.extend(read_manifest(source))
+    names = set()
+    for dataset in datasets:
+        if dataset['name'] in names:
+            raise ValueError("two datasets are named " + dataset['name'])
+        names.add(dataset['name'])
+    return datasets
+
+def run_job(job):
+    """ Optimize one dataset with process_trees, and return a row of the summary table.
+    Any error is caught and reported in the row, so that one dataset cannot stop the batch """
+    (dataset, seed, output_filename, options) = job
+    row = {'name': dataset['name'], 'status': 'ok', 'trees': 0, 'seed': seed, 'start': None,
+        'best': None, 'seconds': None, 'output': output_filename, 'error': ''}
+    started = time.time()
+    try:
+        """ Every dataset gets its own taxon table, so that a worker does not accumulate
+        the taxa of all the datasets it has run """
+        taxa = taxon_table()
+        tree_list = []
+        for filename in dataset['infiles']:
+            tree_list.extend(read_trees(filename, lambda: compact_tree(taxa=taxa)))
+        row['trees'] = len(tree_list)
+        if len(tree_list) < 2:
+            raise ValueError("fewer than two trees")
+        row['start'] = minimize_this(dict((tr.name, tr) for tr in tree_list), options['objective'],
+            options['weights'], options['pair_weights'])
+        random.seed(seed)
+        row['best'] = process_trees(tree_list, output_filename=output_filename, verbose=False,
+            **options)
+    except Exception, e:
+        row['status'] = 'failed'
+        row['error'] = traceback.format_exception_only(type(e), e)[-1].strip()
+    row['seconds'] = time.time() - started
+    return row
+
+def format_row(row):
+    """ The cells of a row of the summary table """
+    cells = dict((c, '' if row[c] is None else str(row[c])) for c in g_columns)
+    if not row['seconds'] is None:
+        cells['seconds'] = "%.2f" % row['seconds']
+    return [cells[c] for c in g_columns]
+
+def run_batch(datasets, jobs=g_jobs, seed=None, output_directory=g_output_directory,
+    summary_filename=g_summary_filename, verbose=True, **options):
+    """Run process_trees on every dataset, on a pool of _jobs_ processes. Dataset i is
+    seeded seed + i unless it has a seed of its own, and a time_limit of its own overrides
+    the one in options (which are passed to process_trees). The summary table is written
+    to output_directory/summary_filename. Returns the rows of the table, in the order of
+    the datasets.
+    """
+    if seed is None:
+        seed = random.randint(0, 2**31 - 1)
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    work = []
+    for i in range(0, len(datasets)):
+        dataset = datasets[i]
+        job_options = dict(options)
+        if 'time_limit' in dataset:
+            job_options['time_limit'] = dataset['time_limit']
+        work.append((dataset, dataset.get('seed', seed + i),
+            dataset.get('output', os.path.join(output_directory, dataset['name'] + '.dat')), job_options))
+    rows = {}
+    pool = None
+    if jobs > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(work)))
+        results = pool.imap_unordered(run_job, work, 1)
+    else:
+        results = (run_job(job) for job in work)
+    try:
+        for i in range(0, len(work)):
+            """ next() with a timeout keeps the pool responsive to ctrl-c """
+            row = results.next(2**31) if not pool is None else results.next()
+            rows[row['name']] = row
+            if verbose:
+                print "[" + str(i + 1) + "/" + str(len(work)) + "] " + row['name'] + ": " + \
+                    (row['status'] + " " + row['error'] if row['status'] != 'ok' else
+                    "Optimize " + str(row['best'])) + " (" + ("%.1f" % row['seconds']) + "s)"
+    finally:
+        if not pool is None:
+            if len(rows) < len(work):
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+    rows = [rows[dataset['name']] for dataset in datasets]
+    with open(os.path.join(output_directory, summary_filename), 'w') as f:
+        f.write("\t".join(g_columns) + "\n")
+        for row in rows:
+            f.write("\t".join(format_row(row)) + "\n")
+    return rows
+
+def print_summary(rows):
+    table = [g_columns] + [format_row(row) for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(0, len(g_columns))]
+    for line in table:
+        print "  ".join(line[i].ljust(widths[i]) for i in range(0, len(line))).rstrip()
+    failed = len([row for row in rows if row['status'] != 'ok'])
+    print str(len(rows) - failed) + " datasets done, " + str(failed) + " failed"
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description = 'Minimize tangling in many datasets on a pool of processes.')
+    parser.add_argument('-d', '--output-directory', default=g_output_directory)
+    parser.add_argument('--jobs', type=int, default=g_jobs,
+        help='number of worker processes')
+    parser.add_argument('--seed', type=int, default=None,
+        help='random seed of the first dataset, the others get the following seeds')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help='print only the summary table')
+    add_objective_arguments(parser)
+    add_search_arguments(parser)
+    parser.add_argument('sources', nargs='+', metavar='manifest-or-directory')
+    args = parser.parse_args()
+    options = objective_options(args)
+    options.update(search_options(args))
+    try:
+        datasets = find_datasets(args.sources)
+    except (IOError, OSError, ValueError), e:
+        raise SystemExit(str(e))
+    rows = run_batch(datasets, args.jobs, args.seed, args.output_directory,
+        verbose = not args.quiet, **options)
+    print_summary(rows)
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+"""
+benchmark.py - Copyright (c) 2012, Howard C. Shaw III
+Licensed under the GNU GPL v3
+
+benchmark.py [options]
+
+Build a synthetic tanglegram - a set of random trees over shared taxa - and time the parts of
+detangle.py that matter for performance:
+
+parse = read_trees throughput on the synthetic trees written as a NEXUS file
+objective = minimize_this evaluations per second (pure Python, and NumPy when installed), and
+incremental scorer updates per second
+process = process_trees time to reach a target score, at a fixed seed
+
+Everything is seeded, so two runs with the same options time the same work. Results are written as
+JSON (benchmark.json by default), and --compare old.json prints the ratio of every rate to an
+earlier run, so that versions can be compared.
+"""
+
+import detangle
+from detangle import read_trees, minimize_this, scorer, process_trees
+import random
+import time
+import json
+import sys
+import argparse
+import platform
+
+""" Tweak these values to change behavior:
+
+Taxa = the number of taxa in the base tree
+Trees = the number of trees in the tanglegram
+Overlap = the probability of each taxon being kept in each tree
+Shared = the fraction of taxa left in place in each tree; the others are shuffled among themselves,
+so 1 gives every tree the same topology and 0 unrelated topologies
+Multifurcation = the probability of collapsing each internal edge, making multifurcations
+Seconds = how long to repeat each rate measurement for
+Target = the fraction of the starting score process_trees has to reach
+"""
+
+g_taxa = 200
+g_trees = 6
+g_overlap = 1.0
+g_shared = 0.5
+g_multifurcation = 0.0
+g_seed = 1
+g_seconds = 2.0
+g_target = 0.8
+g_max_count = 500
+
+def random_topology(taxa, rnd, multifurcation=g_multifurcation):
+    """ A random tree over taxa, as nested lists, built by joining random pairs of subtrees,
+    then collapsing each internal edge with probability multifurcation """
+    nodes = list(taxa)
+    while len(nodes) > 1:
+        a = nodes.pop(rnd.randrange(len(nodes)))
+        b = nodes.pop(rnd.randrange(len(nodes)))
+        nodes.append([a, b])
+    root = nodes[0]
+    if multifurcation > 0:
+        stack = [root]
+        while len(stack) > 0:
+            current = stack.pop()
+            children = []
+            pending = list(current)
+            while len(pending) > 0:
+                c = pending.pop(0)
+                if isinstance(c, list) and rnd.random() < multifurcation:
+                    pending = c + pending
+                else:
+                    children.append(c)
+            current[:] = children
+            stack.extend(c for c in children if isinstance(c, list))
+    return root
+
+def derive(base, taxa, rnd, overlap=g_overlap, shared=g_shared):
+    """ A tree with the topology of base, in which a fraction (1 - shared) of the taxa are
+    shuffled among themselves, each taxon is kept with probability overlap, and the
+    children of every node are shuffled """
+    moved = [x for x in taxa if rnd.random() >= shared]
+    targets = list(moved)
+    rnd.shuffle(targets)
+    relabel = dict(zip(moved, targets))
+    kept = set(x for x in taxa if rnd.random() < overlap)
+
+    def copy(t):
+        if not isinstance(t, list):
+            x = relabel.get(t, t)
+            return x if x in kept else None
+        children = [c for c in (copy(c) for c in t) if not c is None]
+        rnd.shuffle(children)
+        if len(children) == 0:
+            return None
+        if len(children) == 1:
+            return children[0]
+        return children
+    return copy(base)
+
+def newick(t):
+    if not isinstance(t, list):
+        return t
+    return '(' + ','.join(newick(c) for c in t) + ')'
+
+def synthetic_nexus(taxa=g_taxa, trees=g_trees, overlap=g_overlap, shared=g_shared,
+    multifurcation=g_multifurcation, seed=g_seed):
+    """ The lines of a NEXUS file holding a synthetic tanglegram """
+    rnd = random.Random(seed)
+    names = ['taxon' + str(i) for i in range(0, taxa)]
+    base = random_topology(names, rnd, multifurcation)
+    lines = ['#NEXUS\n', '\n', 'begin trees;\n']
+    for k in range(0, trees):
+        t = derive(base, names, rnd, overlap, shared)
+        lines.append('tree T' + str(k) + ' = [&U] ' + newick(t) + ';\n')
+    lines.append('end;\n')
+    return lines
+
+def rate(f, seconds=g_seconds):
+    """ Call f repeatedly for about _seconds_, and return the calls per second """
+    count = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < seconds or count == 0:
+        f()
+        count += 1
+        elapsed = time.time() - start
+    return count / elapsed
+
+def bench_parse(lines, seconds=g_seconds):
+    size = sum(len(x) for x in lines)
+    per_second = rate(lambda: list(read_trees(lines)), seconds)
+    return {'files_per_second': per_second,
+        'trees_per_second': per_second * len(list(read_trees(lines))),
+        'bytes_per_second': per_second * size}
+
+def bench_objective(tree_list, seconds=g_seconds):
+    trees = dict((tr.name, tr) for tr in tree_list)
+    results = {}
+    backends = [False]
+    if not detangle.numpy is None:
+        backends.append(True)
+    saved = detangle.g_use_numpy
+    try:
+        for use_numpy in backends:
+            detangle.g_use_numpy = use_numpy
+            key = 'numpy' if use_numpy else 'python'
+            results[key + '_evaluations_per_second'] = rate(lambda: minimize_this(trees), seconds)
+            """ Every update scores a new random twist, as process_trees does, and the cache is
+            off, so that cache hits are not timed as updates """
+            sc = scorer(trees, cache_size=0)
+            names = sorted(trees.keys())
+            rnd = random.Random(g_seed)
+            state = {'i': 0}
+            def update():
+                name = names[state['i'] % len(names)]
+                state['i'] += 1
+                tr = trees[name]
+                t = tr.get_twists()
+                if len(t) == 0:
+                    return
+                moved = list(t)
+                k = rnd.randint(0, len(t) - 1)
+                moved[k] += 1
+                sc.update(name, tr.apply_twists(moved))
+                tr.apply_twists(t)
+                sc.reject()
+            results[key + '_updates_per_second'] = rate(update, seconds)
+    finally:
+        detangle.g_use_numpy = saved
+    return results
+
+def bench_process(lines, target=g_target, seed=g_seed, max_count=g_max_count):
+    tree_list = list(read_trees(lines))
+    start_score = minimize_this(dict((tr.name, tr) for tr in tree_list))
+    random.seed(seed)
+    start = time.time()
+    best = process_trees(tree_list, max_count=max_count, output_filename=None, verbose=False,
+        target=start_score * target)
+    return {'seconds': time.time() - start, 'start_score': start_score, 'final_score': best,
+        'target_score': start_score * target, 'reached': best <= start_score * target}
+
+def compare(new, old):
+    """ Print the ratio new/old of every number both results share """
+    for section in sorted(new['results'].keys()):
+        for key in sorted(new['results'][section].keys()):
+            a = new['results'][section][key]
+            b = old.get('results', {}).get(section, {}).get(key)
+            if isinstance(a, (int, float)) and isinstance(b, (int, float)) and b != 0 \
+                and not isinstance(a, bool):
+                print section + "." + key + ": " + str(b) + " -> " + str(a) + " (" + \
+                    ("%.2f" % (float(a) / b)) + "x)"
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description = 'Time detangle on a synthetic tanglegram.')
+    parser.add_argument('--taxa', type=int, default=g_taxa)
+    parser.add_argument('--trees', type=int, default=g_trees)
+    parser.add_argument('--overlap', type=float, default=g_overlap)
+    parser.add_argument('--shared', type=float, default=g_shared)
+    parser.add_argument('--multifurcation', type=float, default=g_multifurcation)
+    parser.add_argument('--seed', type=int, default=g_seed)
+    parser.add_argument('--seconds', type=float, default=g_seconds)
+    parser.add_argument('--target', type=float, default=g_target,
+        help='fraction of the starting score process_trees has to reach')
+    parser.add_argument('--max-count', type=int, default=g_max_count)
+    parser.add_argument('--only', choices=['parse', 'objective', 'process'], action='append',
+        help='run only these benchmarks (repeatable)')
+    parser.add_argument('-o', '--output-filename', dest='output_filename', default='benchmark.json')
+    parser.add_argument('--write-trees', default=None, metavar='FILE',
+        help='also save the synthetic trees as a NEXUS file')
+    parser.add_argument('--compare', default=None, metavar='JSON',
+        help='print the ratio of every result to those in an earlier results file')
+    args = parser.parse_args()
+
+    lines = synthetic_nexus(args.taxa, args.trees, args.overlap, args.shared,
+        args.multifurcation, args.seed)
+    if not args.write_trees is None:
+        with open(args.write_trees, 'w') as f:
+            f.writelines(lines)
+    only = args.only or ['parse', 'objective', 'process']
+    results = {}
+    if 'parse' in only:
+        results['parse'] = bench_parse(lines, args.seconds)
+    if 'objective' in only:
+        results['objective'] = bench_objective(list(read_trees(lines)), args.seconds)
+    if 'process' in only:
+        results['process'] = bench_process(lines, args.target, args.seed, args.max_count)
+    report = {'config': vars(args), 'python': sys.version.split()[0], 'platform': platform.platform(),
+        'numpy': None if detangle.numpy is None else detangle.numpy.__version__,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+    with open(args.output_filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print json.dumps(results, indent=2, sort_keys=True)
+    if not args.compare is None:
+        with open(args.compare, 'r') as f:
+            compare(report, json.load(f))
@@ -9,18 +9,39 @@ detangle.py [filename] ...
 Pass any number of filenames, detangle will extract all trees, and optimize them all simultaneously,
 minimizing on all combinations of trees.
 
-Results are output in result1.dat and result2.dat - the program alternates the filename so if you use
-ctrl-c to break the execution, one of the two files will have valid data, even if you break during a write.
+Trees are read from NEXUS files (trees blocks, with or without a Translate block, on one line or
+many) or from plain Newick files, with quoted labels, branch lengths and comments.
+
+Results are checkpointed while running, by a background thread, at most once every
+--checkpoint-interval seconds, and when the program exits or is interrupted with ctrl-c. Each
+checkpoint replaces result.dat (or the -o file) and result.dat.ckpt atomically, so both always hold
+valid data. The .ckpt file holds the full optimizer state, and --resume result.dat.ckpt continues
+a killed run exactly where that checkpoint left it.
 
 Results are not the same with every run - the algorithm is stochastic, and may find different local
-minima, so multiple runs are recommended.
+minima, so multiple runs are recommended. Use --restarts N to do this in one go: N independent runs
+with recorded seeds are made (on --jobs J processes), the best result is written to the output file,
+and the score of every seed is listed in the output file name + '.seeds'.
 """
 
 from sys import argv
-import fileinput
-from collections import deque
+from collections import deque, OrderedDict
+from array import array
 import itertools
+import bisect
 import random
+import re
+import argparse
+import multiprocessing
+import threading
+import time
+import os
+import signal
+import cPickle as pickle
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 """ Tweak these values to change behavior:
 
@@ -30,7 +51,36 @@ Max Count = stop after this many iterations - you can use ctrl-c to stop prematu
 Max Iterations = reduce this if you want it to stop when it reaches Intensity 1 and no improvement
 is seen for this many iterations
 Intensity Reduction = what percent to reduce the intensity to each step
+Schedule = 'fixed' to reduce the intensity as above, or 'adaptive' to set it from the acceptance rate:
+after every Adapt Window moves tried, it is multiplied by Adapt Step if more than Target Acceptance
+of them were accepted, and divided by it if fewer were (between 1 and Starting Intensity)
+Stop Window, Stop Epsilon = None to run until the intensity runs out, or stop as soon as the best
+value has improved by no more than Stop Epsilon over the last Stop Window iterations
+Time Limit = None, or the number of seconds after which to stop with the best layout found so far
+Candidates = the number of random moves drawn for a tree at each step; more than 1 scores them
+all in one pass (vectorized with NumPy) and tries only the best
 Skip First Tree = 0 for reordering all trees, 1 to leave the first tree fixed
+One-Sided Start = 1 to start process_trees from the layout one_sided finds, with every other tree
+rotated to cross the first tree as little as possible
+Exact Time Limit = the number of seconds the exact solver searches before settling for the best
+layout found, and reporting how far it may be from the optimum
+Objective = 'tangle' for the fast adjacent-leaf proxy, 'crossing' for the true number of crossing lines
+Weights = the weight of each component of the value minimized, on top of the defaults of 1 for
+'flatness' and the objective and 0.5 for 'alpha'; e.g. {'crossing': 1, 'tangle': 0}. Components with
+weight 0 are not computed. More components can be added with register_component.
+Pair Weights = the weight of each pair of trees, by name, e.g. {('W', '*'): 1, ('*', '*'): 0} to
+only compare W with every other tree ('*' matches any tree). Pairs not listed have weight 1, and
+pairs with weight 0 are not scored at all.
+Use NumPy = score all pairs with vectorized NumPy operations (on by default when NumPy is installed)
+Checkpoint Interval = the minimum number of seconds between two checkpoints
+Report Interval = the minimum number of seconds between two progress lines
+Anchor = None to score every pair of trees, or the name of a tree (or 'consensus', for the order of
+the taxa by their mean position in all the trees) to score every tree against that one only, so
+that the work grows linearly with the number of trees
+Sample Pairs = None to score every pair involving a twisted tree, or the number of those pairs,
+picked at random, to score each move on; the others are re-scored every Refresh Interval iterations
+Cache Size = the number of recently scored layouts (per optimization) whose leaf orders and scores
+are kept, so that revisiting one costs no evaluation; 0 disables the cache
 
 Note that because the iterations are done for each of the trees, the max_iterations may stop
 the process before the max_count implies it should, because it is actually counting num_trees times
@@ -39,71 +89,363 @@ as fast.
 
 g_starting_intensity = 50
 g_number_of_iterations_before_reducing_intensity = 50
-g_max_count = 2500
-g_max_iterations_without_improvement = 2500
+g_max_count = 5000
+g_max_iterations_without_improvement = 5000
 g_intensity_reduction = 0.99
+g_schedule = 'fixed'
+g_target_acceptance = 0.2
+g_adapt_window = 50
+g_adapt_step = 1.25
+g_stop_window = None
+g_stop_epsilon = 0
+g_time_limit = None
+g_candidates = 1
 g_skip_first_tree = 0
+g_one_sided_start = 0
+g_exact_time_limit = 60.0
+g_objective = 'tangle'
+g_weights = {}
+g_pair_weights = {}
+g_use_numpy = numpy is not None
+g_checkpoint_interval = 30
+g_report_interval = 1.0
+g_cache_size = 1000
+g_anchor = None
+g_sample_pairs = None
+g_refresh_interval = 10
 g_output_filename = "result.dat"
 
+class taxon_table:
+    """ taxon_table: this class maps every leaf name to a dense integer id, so that
+         trees can be compared by array lookups instead of hashing names. Trees loaded
+         together share one table (g_taxa unless told otherwise).
+    """
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.rank = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        """ Return the id of name, adding it to the table if it is new """
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+            self.rank = None
+        return i
+
+    def ranks(self):
+        """ An array giving the alphabetical rank of every taxon id """
+        if self.rank is None or len(self.rank) != len(self.names):
+            self.rank = array('i', [0]) * len(self.names)
+            order = sorted(range(0, len(self.names)), key=lambda i: self.names[i])
+            for r in range(0, len(order)):
+                self.rank[order[r]] = r
+        return self.rank
+
+g_taxa = taxon_table()
+
+def position_index(order, size):
+    """ Invert a leaf order of taxon ids into an array of positions indexed by taxon id,
+        holding -1 for every taxon that is not in the order """
+    pos = array('i', [-1]) * size
+    for i in range(0, len(order)):
+        pos[order[i]] = i
+    return pos
+
+_statement_re = re.compile(r"[;'\[]")
+_newick_re = re.compile(r"\s*(?:([(),;])|:\s*([^(),;\s]*)|'((?:[^']|'')*)'|([^(),:;\s']+))")
+_label_re = re.compile(r"\s*(?:'((?:[^']|'')*)'|([^\s=,;']+))")
+_default_re = re.compile(r"\s*\*?")
+_unquoted_re = re.compile(r"^[^\s(),:;'\[\]]+$")
+
+def nexus_statements(lines):
+    """ This generator splits a stream of lines into ';' terminated statements,
+    skipping [comments], keeping 'quoted' text intact, in a single pass """
+    buf = []
+    in_comment = False
+    in_quote = False
+    for line in lines:
+        i = 0
+        n = len(line)
+        while i < n:
+            if in_comment:
+                j = line.find(']', i)
+                if j == -1:
+                    break
+                in_comment = False
+                i = j + 1
+            elif in_quote:
+                j = line.find("'", i)
+                if j == -1:
+                    buf.append(line[i:])
+                    break
+                if line[j+1:j+2] == "'":
+                    buf.append(line[i:j+2])
+                    i = j + 2
+                else:
+                    buf.append(line[i:j+1])
+                    in_quote = False
+                    i = j + 1
+            else:
+                m = _statement_re.search(line, i)
+                if m is None:
+                    buf.append(line[i:])
+                    break
+                j = m.start()
+                buf.append(line[i:j])
+                c = line[j]
+                if c == '[':
+                    in_comment = True
+                elif c == "'":
+                    buf.append(c)
+                    in_quote = True
+                else:
+                    yield ''.join(buf).strip()
+                    buf = []
+                i = j + 1
+    rest = ''.join(buf).strip()
+    if len(rest) > 0:
+        yield rest
+
+def read_label(text, i=0):
+    """ Read one (possibly quoted) label from text at i, returning it and the index after it """
+    m = _label_re.match(text, i)
+    if m is None:
+        return (None, i)
+    if m.group(1) is None:
+        return (m.group(2), m.end())
+    return (m.group(1).replace("''", "'"), m.end())
+
+def newick_label(name):
+    """ Quote a label for output if it holds characters Newick reserves """
+    if name is None or _unquoted_re.match(name):
+        return name
+    return "'" + name.replace("'", "''") + "'"
+
+def parse_newick(text, translate=None):
+    """ Parse a Newick string in one pass with an index-based tokenizer, returning lists of
+    the parent id and the name of every node, indexed by node id (numbered in preorder).
+    Branch lengths are skipped, quoted labels unquoted, internal node labels kept, and
+    leaf labels found in translate (a Translate block map) replaced. """
+    parent = []
+    names = []
+    stack = []
+    cur = -1
+    last = -1
+    pos = 0
+    n = len(text)
+    while pos < n:
+        m = _newick_re.match(text, pos)
+        if m is None:
+            break
+        pos = m.end()
+        (punct, length, quoted, plain) = m.groups()
+        if punct == '(':
+            parent.append(cur)
+            names.append(None)
+            stack.append(cur)
+            cur = len(parent) - 1
+            last = -1
+        elif punct == ')':
+            if len(stack) == 0:
+                raise ValueError("unbalanced parentheses in tree")
+            last = cur
+            cur = stack.pop()
+        elif punct == ',':
+            last = -1
+        elif punct == ';':
+            break
+        elif not length is None:
+            pass
+        else:
+            label = plain if quoted is None else quoted.replace("''", "'")
+            if last != -1:
+                names[last] = label
+            else:
+                if not translate is None:
+                    label = translate.get(label, label)
+                parent.append(cur)
+                names.append(label)
+                last = len(parent) - 1
+    return (parent, names)
+
+def parse_tree_statement(text, translate=None):
+    """ Parse a 'tree NAME = (...)' statement, returning its name and parse_newick lists """
+    i = len(text) - len(text.lstrip())
+    i += len(text[i:].split(None, 1)[0])
+    """ A '*' marks the default tree """
+    m = _default_re.match(text, i)
+    (name, i) = read_label(text, m.end())
+    i = text.find('=', i)
+    (parent, names) = parse_newick(text[i+1:], translate)
+    return (name, parent, names)
+
+def read_trees(source, factory=None):
+    """ This generator reads trees one at a time from a file name, file object or other
+    sequence of lines, holding either a NEXUS trees block (applying its Translate map)
+    or plain Newick trees (which are named tree1, tree2, ...). Each tree is built by
+    calling factory() (compact_tree by default) and passing it the parsed lists. """
+    if factory is None:
+        factory = compact_tree
+    if isinstance(source, basestring):
+        with open(source, 'r') as f:
+            for tr in read_trees(f, factory):
+                yield tr
+        return
+    translate = None
+    count = 0
+    for statement in nexus_statements(source):
+        if statement.startswith('\xef\xbb\xbf'):
+            statement = statement[3:]
+        if statement[0:6].lower() == '#nexus':
+            statement = statement[6:].lstrip()
+        keyword = statement.split(None, 1)[0].lower() if len(statement) > 0 else ''
+        if keyword == 'translate':
+            translate = {}
+            i = len('translate')
+            while i < len(statement):
+                (key, i) = read_label(statement, i)
+                (label, i) = read_label(statement, i)
+                if key is None or label is None:
+                    break
+                translate[key] = label
+                i = statement.find(',', i)
+                if i == -1:
+                    break
+                i += 1
+        elif keyword == 'tree' or keyword == 'utree':
+            count += 1
+            (name, parent, names) = parse_tree_statement(statement, translate)
+            tr = factory()
+            tr.init_from_lists(name, parent, names)
+            yield tr
+        elif keyword == 'begin' or keyword == 'end' or keyword == 'endblock':
+            translate = None
+        elif statement.startswith('('):
+            count += 1
+            (parent, names) = parse_newick(statement, translate)
+            tr = factory()
+            tr.init_from_lists('tree' + str(count), parent, names)
+            yield tr
+
+def sniff_format(filename):
+    """ Guess the format of a tree file from its first line that is not blank:
+    'nexus', 'phyloxml' (for any XML) or 'newick' """
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('\xef\xbb\xbf'):
+                line = line[3:]
+            line = line.strip()
+            if line == '':
+                continue
+            if '#nexus' in line.lower():
+                return 'nexus'
+            if line.startswith('<'):
+                return 'phyloxml'
+            break
+    return 'newick'
+
+def foreign_lists(root, children, label):
+    """ The lists of parent ids and names, indexed by preorder node id as parse_newick returns
+    them, of a tree held in another library's objects, found by an iterative walk from root.
+    children(x) and label(x) give the children and the name of one of its nodes """
+    parent = []
+    names = []
+    stack = [(root, -1)]
+    while len(stack) > 0:
+        (current, p) = stack.pop()
+        parent.append(p)
+        names.append(label(current))
+        v = len(parent) - 1
+        for n in reversed(list(children(current))):
+            stack.append((n, v))
+    return (parent, names)
+
+def phylo_trees(filename, factory=None, tree_format=None):
+    """ This generator reads the trees of a file with Bio.Phylo (in tree_format, or the format
+    sniff_format guesses), building each straight from the Bio.Phylo tree as soon as it is
+    parsed, so that only one Bio.Phylo tree is held at a time. Needs Biopython. """
+    from Bio import Phylo
+    if factory is None:
+        factory = compact_tree
+    if tree_format is None:
+        tree_format = sniff_format(filename)
+    count = 0
+    for phylo in Phylo.parse(filename, tree_format):
+        count += 1
+        (parent, names) = foreign_lists(phylo.clade, lambda c: c.clades, lambda c: c.name)
+        tr = factory()
+        tr.init_from_lists(phylo.name or 'tree' + str(count), parent, names)
+        yield tr
+
+def dendropy_trees(filename, factory=None, tree_format=None):
+    """ This generator reads the trees of a file with DendroPy, as phylo_trees does. Leaves are
+    named by their taxon labels and the trees by their labels, read from the DendroPy objects
+    rather than from a Newick string written and parsed again. Needs DendroPy. """
+    import dendropy
+    if factory is None:
+        factory = compact_tree
+    if tree_format is None:
+        tree_format = sniff_format(filename)
+    def label(nd):
+        if not nd.taxon is None:
+            return nd.taxon.label
+        return nd.label
+    def convert(source):
+        count = 0
+        for dtree in source:
+            count += 1
+            (parent, names) = foreign_lists(dtree.seed_node, lambda nd: nd.child_nodes(), label)
+            tr = factory()
+            tr.init_from_lists(dtree.label or 'tree' + str(count), parent, names)
+            yield tr
+    if hasattr(dendropy.Tree, 'yield_from_files'):
+        source = dendropy.Tree.yield_from_files(files=[filename], schema=tree_format)
+    elif hasattr(dendropy, 'tree_source_iter'):
+        """ The file is closed once the trees are read, or the generator is dropped """
+        with open(filename, 'r') as f:
+            for tr in convert(dendropy.tree_source_iter(f, schema=tree_format)):
+                yield tr
+        return
+    else:
+        source = dendropy.TreeList.get_from_path(filename, tree_format)
+    for tr in convert(source):
+        yield tr
+
 class tree:
     """ tree: this class encapsulates the individual trees, and anchors the root
          The structure of the tree is never changed once it is created. Instead,
          twists are stored separately and applied on the fly in the output functions.
     """
     def __init__(self, line=None):
+        self.name = None
         self.root = None
         if not line is None:
-            self.name = line[5:line.find(' ',6)]
-            self.parse(line[line.find('(',6)+1:].strip(';'))
-            self.twist_apply_list = self.non_leaves()
+            for statement in nexus_statements([line]):
+                self.init_from_lists(*parse_tree_statement(statement))
         #print self.twist_apply_list
 
     def parse(self, line):
-        curstr = line
-        self.root = node();
-        cur = self.root;
-        stack = [self.root];
-        print line
-        while len(curstr) > 0:
-            if curstr[0] == '(':
-                temp = node()
-                cur.add(temp)
-                stack.append(cur)
-                cur = temp
-                curstr = curstr[1:]
-            elif curstr[0] == ',':
-                curstr = curstr[1:]
-            elif curstr[0] == ')':
-                cur = stack.pop()
-                curstr = curstr[1:]
-            else:
-                comma = curstr.find(',')
-                paren = curstr.find(')')
-                if comma == -1:
-                    comma = paren
-                if paren == -1:
-                    paren = comma
-                if min(comma,paren) > -1:
-                    name = curstr[0:min(comma,paren)]
-                    cur.add(node(name))
-                    curstr = curstr[min(comma,paren):]
-                else:
-                    curstr = ''
+        """ Parse a Newick string into this tree """
+        self.init_from_lists(self.name, *parse_newick(line))
 
-    def init_from_phylo(self, phylo):
-        self.name = phylo.name
-        self.root = node()
-        self.init_from_phylo_clade(self.root, phylo.clade)
+    def init_from_lists(self, name, parent, names):
+        """ Build the tree from lists of parent ids and names, indexed by (preorder) node id """
+        self.name = name
+        nodes = [node(x) for x in names]
+        for v in range(1, len(nodes)):
+            nodes[parent[v]].add(nodes[v])
+        self.root = nodes[0] if len(nodes) > 0 else None
         self.twist_apply_list = self.non_leaves()
 
-    def init_from_phylo_clade(self, cur, clade):
-        if not clade.name is None:
-            cur.name = clade.name
-        for i in clade.clades:
-            n = node()
-            self.init_from_phylo_clade(n, i)
-            cur.add(n)
-            
+    def init_from_phylo(self, phylo):
+        self.init_from_lists(phylo.name, *foreign_lists(phylo.clade, lambda c: c.clades, lambda c: c.name))
+
     def leaves(self):
         d = deque()
         self.root.leaves(d)
@@ -114,10 +456,29 @@ class tree:
         self.root.non_leaves(d)
         return d        
 
+    def leaf_taxa(self, taxa=None):
+        """ The leaves in their current order, as ids from the taxon table """
+        if taxa is None:
+            taxa = g_taxa
+        return array('i', (taxa.intern(x) for x in self.leaves()))
+
+    def positions(self, taxa=None):
+        """ The position of every taxon in the current order, indexed by taxon id """
+        if taxa is None:
+            taxa = g_taxa
+        order = self.leaf_taxa(taxa)
+        return position_index(order, len(taxa))
+
     def apply_twists(self, twists):
         for i in range(0,min(len(self.twist_apply_list),len(twists))):
             self.twist_apply_list[i].set_twist(twists[i])
 
+    def twist_sizes(self):
+        """ The number of children of the node of every twist. A twist is only meaningful
+        modulo its size, and two twist lists reduced this way give the same layout exactly
+        when they are equal """
+        return [len(x.children) for x in self.twist_apply_list]
+
     def get_twists(self):
         return [x.twist for x in self.twist_apply_list]
 
@@ -127,11 +488,10 @@ class tree:
 
     def write(self, f):
         f.write("tree ")
-        f.write(self.name)
+        f.write(newick_label(self.name))
         f.write(" = [&U] ")
-        f.write(self.writable())
+        f.writelines(self.root.newick_parts())
         f.write(";\n")
-        pass
 
     def writable(self):
         return self.root.writable()
@@ -162,6 +522,9 @@ class node:
         self.name = name
 
     def set_twist(self, n):
+        """ Rotating k children by k leaves them as they are, so keep the twist below k """
+        if len(self.children) > 0:
+            n = n % len(self.children)
         self.twist = n
 
     def add(self, n):
@@ -175,39 +538,364 @@ class node:
     def has_children(self):
         return (len(self.children) > 0)
 
+    """ The traversals below keep their own stack instead of recursing, so that deep
+    (e.g. ladder-like) trees cannot exceed the recursion limit """
     def leaves(self, d):
-        if len(self.children) == 0:
-            d.append(self.name)
-        else:
-            c = self.get_children()
-            for n in c:
-                n.leaves(d)
+        stack = [self]
+        while len(stack) > 0:
+            current = stack.pop()
+            if len(current.children) == 0:
+                d.append(current.name)
+            else:
+                c = current.get_children()
+                c.reverse()
+                stack.extend(c)
 
     def non_leaves(self, d):
-        if len(self.children) > 0:
-            d.append(self)
-            c = self.get_children()
-            for n in c:
-                n.non_leaves(d)
+        stack = [self]
+        while len(stack) > 0:
+            current = stack.pop()
+            if len(current.children) > 0:
+                d.append(current)
+                c = current.get_children()
+                c.reverse()
+                stack.extend(c)
 
     def output(self, depth):
-        if len(self.children) == 0:
-            print depth * ' ', '|', self.name
-        else:
-            d = self.get_children()
-            for n in d:
-                n.output(depth+1)               
+        stack = [(self, depth)]
+        while len(stack) > 0:
+            (current, depth) = stack.pop()
+            if len(current.children) == 0:
+                print depth * ' ', '|', current.name
+            else:
+                c = current.get_children()
+                c.reverse()
+                stack.extend((n, depth+1) for n in c)
+
+    def newick_parts(self):
+        """ The Newick text of this subtree, generated piece by piece in a single pass """
+        stack = [self]
+        while len(stack) > 0:
+            current = stack.pop()
+            if isinstance(current, basestring):
+                yield current
+            elif len(current.children) == 0:
+                yield newick_label(current.name)
+            else:
+                yield "("
+                stack.append(")")
+                c = list(current.get_children())
+                for j in range(len(c) - 1, -1, -1):
+                    stack.append(c[j])
+                    if j > 0:
+                        stack.append(",")
 
     def writable(self):
-        if len(self.children) == 0:
-            return self.name
-        else:
-            ret = "("
-            d = self.get_children()
-            for n in d:
-                ret = ret + n.writable() + ","
-            ret = ret.rstrip(",") + ")"
-            return ret
+        return "".join(self.newick_parts())
+
+class compact_tree(object):
+    """ compact_tree: a flattened, array-backed equivalent of tree, for large tree sets.
+         Nodes are integer ids numbered in (untwisted) preorder, with the root at 0.
+         parent[v] is the parent of node v (-1 for the root), and the children of v are
+         child[offset[v]:offset[v+1]]. Leaves are kept as ids from a shared taxon_table
+         (-1 for internal nodes), and twists in a per-node int array, applied as the
+         same rotation node uses. Once built, the current leaf order and its position
+         index are kept up to date together with the span of every node, the leaves
+         under v being order[start[v]:start[v]+size[v]]. Twisting v only permutes that
+         span, so apply_twists rewrites just the spans of the nodes it changed, and
+         returns the range of positions it touched.
+         It offers the same interface as tree, so it can be handed to process_trees.
+    """
+    __slots__ = ('name', 'taxa', 'parent', 'offset', 'child', 'taxon', 'twist', 'internal',
+        'size', 'start', 'order', 'pos', 'plan')
+
+    def __init__(self, line=None, taxa=None):
+        if taxa is None:
+            taxa = g_taxa
+        self.name = None
+        self.taxa = taxa
+        self._build([], [])
+        if not line is None:
+            for statement in nexus_statements([line]):
+                self.init_from_lists(*parse_tree_statement(statement))
+
+    def __getstate__(self):
+        """ The plan of twisted_orders is rebuilt when needed rather than pickled """
+        return dict((k, getattr(self, k)) for k in self.__slots__ if k != 'plan')
+
+    def __setstate__(self, state):
+        self.plan = None
+        for (k, v) in state.iteritems():
+            setattr(self, k, v)
+
+    def _build(self, parent, names):
+        """ Fill the arrays from a list of parent ids and a list of names, both indexed
+            by node id, where every node id is greater than that of its parent """
+        n = len(parent)
+        counts = array('i', [0]) * (n + 1)
+        for v in range(1, n):
+            counts[parent[v] + 1] += 1
+        offset = array('i', [0]) * (n + 1)
+        for v in range(0, n):
+            offset[v + 1] = offset[v] + counts[v + 1]
+        fill = array('i', offset)
+        child = array('i', [0]) * max(n - 1, 0)
+        for v in range(1, n):
+            p = parent[v]
+            child[fill[p]] = v
+            fill[p] += 1
+        self.parent = array('i', parent)
+        self.offset = offset
+        self.child = child
+        self.taxon = array('i', (self.taxa.intern(names[v]) if offset[v + 1] == offset[v] else -1
+            for v in range(0, n)))
+        self.twist = array('i', [0]) * n
+        self.internal = array('i', (v for v in range(0, n) if offset[v + 1] > offset[v]))
+        size = array('i', (1 if offset[v + 1] == offset[v] else 0 for v in range(0, n)))
+        for v in range(n - 1, 0, -1):
+            size[parent[v]] += size[v]
+        self.size = size
+        self.start = None
+        self.order = None
+        self.pos = None
+        self.plan = None
+
+    def parse(self, line):
+        """ Parse a Newick string into this tree """
+        self._build(*parse_newick(line))
+
+    def init_from_lists(self, name, parent, names):
+        """ Build the tree from lists of parent ids and names, indexed by (preorder) node id """
+        self.name = name
+        self._build(parent, names)
+
+    def init_from_tree(self, tr):
+        """ Copy the structure, names and twists of a (node based) tree """
+        self.name = tr.name
+        parent = []
+        names = []
+        twists = []
+        stack = [(tr.root, -1)]
+        while len(stack) > 0:
+            (current, p) = stack.pop()
+            parent.append(p)
+            names.append(current.name)
+            twists.append(current.twist)
+            v = len(parent) - 1
+            for n in reversed(current.children):
+                stack.append((n, v))
+        self._build(parent, names)
+        self.apply_twists([twists[v] for v in self.internal])
+
+    def init_from_phylo(self, phylo):
+        self.init_from_lists(phylo.name, *foreign_lists(phylo.clade, lambda c: c.clades, lambda c: c.name))
+
+    def has_children(self, v):
+        return self.offset[v + 1] > self.offset[v]
+
+    def children(self, v):
+        """ The children of node v, in the order given by its twist """
+        lo = self.offset[v]
+        k = self.offset[v + 1] - lo
+        t = self.twist[v]
+        return [self.child[lo + (j - t) % k] for j in range(0, k)]
+
+    def leaves(self):
+        names = self.taxa.names
+        return [names[x] for x in self.leaf_taxa()]
+
+    def layout(self, v):
+        """ Rewrite the span of node v in the leaf order (and position index), and the
+        spans of the nodes under it, from the current twists """
+        offset = self.offset
+        child = self.child
+        twist = self.twist
+        taxon = self.taxon
+        start = self.start
+        order = self.order
+        pos = self.pos
+        p = start[v]
+        stack = [v]
+        while len(stack) > 0:
+            u = stack.pop()
+            start[u] = p
+            lo = offset[u]
+            k = offset[u + 1] - lo
+            if k == 0:
+                order[p] = taxon[u]
+                if not pos is None:
+                    pos[taxon[u]] = p
+                p += 1
+            else:
+                t = twist[u]
+                for j in range(k - 1, -1, -1):
+                    stack.append(child[lo + (j - t) % k])
+
+    def leaf_taxa(self, taxa=None):
+        """ The leaves in their current order, as ids from the taxon table. The array is
+        updated in place by apply_twists, so copy it to keep an old order """
+        if not taxa is None and not taxa is self.taxa:
+            return array('i', (taxa.intern(x) for x in self.leaves()))
+        if self.order is None:
+            self.start = array('i', [0]) * len(self.parent)
+            self.order = array('i', [0]) * (self.size[0] if len(self.parent) > 0 else 0)
+            self.pos = None
+            if len(self.parent) > 0:
+                self.layout(0)
+        return self.order
+
+    def positions(self, taxa=None):
+        """ The position of every taxon in the current order, indexed by taxon id, and
+        updated in place like leaf_taxa """
+        if not taxa is None and not taxa is self.taxa:
+            return position_index(self.leaf_taxa(taxa), len(taxa))
+        if self.pos is None or len(self.pos) != len(self.taxa):
+            self.pos = position_index(self.leaf_taxa(), len(self.taxa))
+        return self.pos
+
+    def non_leaves(self):
+        return self.internal
+
+    def apply_twists(self, twists):
+        """ Set the twists, and update the leaf order if it has been built. Returns the
+        range (lo, hi) of positions of the leaf order that may have changed, or None if
+        the order is rebuilt from scratch when next asked for or nothing changed """
+        internal = self.internal
+        twist = self.twist
+        changed = []
+        offset = self.offset
+        for i in range(0,min(len(internal),len(twists))):
+            v = internal[i]
+            t = twists[i]
+            if twist[v] != t:
+                t = t % (offset[v + 1] - offset[v])
+                if twist[v] != t:
+                    twist[v] = t
+                    changed.append(v)
+        if len(changed) == 0 or self.order is None:
+            return None
+        if not self.pos is None and len(self.pos) != len(self.taxa):
+            self.pos = None
+        start = self.start
+        size = self.size
+        lo = min(start[v] for v in changed)
+        hi = max(start[v] + size[v] for v in changed)
+        if 2 * (hi - lo) > len(self.order):
+            """ Rebuilding the whole order in one pass is cheaper than many rewrites """
+            self.order = None
+            self.pos = None
+            return None
+        """ Spans nest, so going left to right, a node inside a span just rewritten is done """
+        changed.sort(key=lambda v: start[v])
+        hi = lo
+        for v in changed:
+            if start[v] >= hi:
+                self.layout(v)
+            hi = max(hi, start[v] + size[v])
+        return (lo, hi)
+
+    def twisted_orders(self, twists):
+        """ With NumPy: the leaf orders (as taxon ids) the tree would have under each of the
+        lists of twists (ordered as get_twists returns them), as the rows of an array, found
+        without changing the tree. The span of a node starts where that of its parent does,
+        plus the sizes of the siblings its parent's twist puts ahead of it; the spans are
+        worked out for all the lists at once, one level of the tree at a time """
+        n = len(self.parent)
+        if self.plan is None:
+            offset = numpy.array(self.offset, dtype=numpy.int64)
+            size = numpy.array(self.size, dtype=numpy.int64)
+            parent = numpy.array(self.parent, dtype=numpy.int64)
+            column = numpy.zeros(n, dtype=numpy.int64)
+            column[numpy.array(self.internal, dtype=numpy.int64)] = numpy.arange(len(self.internal))
+            """ c[u]: where node u is in child, and prefix[c]: the sizes of the children
+            of the same node ahead of child[c] when untwisted """
+            c = numpy.zeros(n, dtype=numpy.int64)
+            c[numpy.array(self.child, dtype=numpy.int64)] = numpy.arange(len(self.child))
+            u = numpy.arange(1, n)
+            v = parent[1:]
+            prefix = numpy.cumsum(size[self.child]) - size[self.child]
+            prefix -= prefix[offset[parent[self.child]]] if len(self.child) > 0 else 0
+            depth = array('i', [0]) * n
+            for x in range(1, n):
+                depth[x] = depth[self.parent[x]] + 1
+            depth = numpy.array(depth, dtype=numpy.int64)
+            levels = [numpy.nonzero(depth == d)[0] for d in range(1, int(depth.max()) + 1)] if n > 1 else []
+            leaves = numpy.nonzero(offset[1:] == offset[:-1])[0]
+            self.plan = (column[v], offset[v + 1] - offset[v], prefix[c[u]], offset[v], prefix,
+                size[v], c[u] - offset[v], parent, levels, leaves,
+                numpy.array(self.taxon, dtype=numpy.int64)[leaves])
+        (column, k, ahead, first, prefix, total, index, parent, levels, leaves, taxa) = self.plan
+        twists = numpy.asarray(twists, dtype=numpy.int64).reshape(-1, len(self.internal))
+        m = twists.shape[0]
+        """ s: the index of the child the twist of the parent puts first """
+        s = (k - twists[:, column] % k) % k
+        rel = numpy.zeros((m, n), dtype=numpy.int64)
+        rel[:, 1:] = ahead - prefix[first + s] + total * (index < s)
+        start = numpy.zeros((m, n), dtype=numpy.int64)
+        for level in levels:
+            start[:, level] = start[:, parent[level]] + rel[:, level]
+        orders = numpy.empty((m, len(leaves)), dtype=numpy.int64)
+        orders[numpy.arange(m)[:, None], start[:, leaves]] = taxa[None, :]
+        return orders
+
+    def twist_sizes(self):
+        """ The number of children of the node of every twist, as in tree """
+        offset = self.offset
+        return [offset[v + 1] - offset[v] for v in self.internal]
+
+    def get_twists(self):
+        twist = self.twist
+        return [twist[v] for v in self.internal]
+
+    def print_tree(self):
+        print self.name
+        stack = [(0, 1)]
+        while len(stack) > 0:
+            (v, depth) = stack.pop()
+            if self.has_children(v):
+                for n in reversed(self.children(v)):
+                    stack.append((n, depth + 1))
+            else:
+                print depth * ' ', '|', self.taxa.names[self.taxon[v]]
+
+    def write(self, f):
+        f.write("tree ")
+        f.write(newick_label(self.name))
+        f.write(" = [&U] ")
+        f.writelines(self.newick_parts())
+        f.write(";\n")
+
+    def newick_parts(self):
+        """ The Newick text of the tree, generated piece by piece in a single pass """
+        names = self.taxa.names
+        stack = [0]
+        while len(stack) > 0:
+            v = stack.pop()
+            if v == -1:
+                yield ")"
+            elif v == -2:
+                yield ","
+            elif self.has_children(v):
+                yield "("
+                stack.append(-1)
+                c = self.children(v)
+                for j in range(len(c) - 1, -1, -1):
+                    stack.append(c[j])
+                    if j > 0:
+                        stack.append(-2)
+            else:
+                yield newick_label(names[self.taxon[v]])
+
+    def writable(self):
+        return "".join(self.newick_parts())
+
+    def max_depth(self):
+        depth = array('i', [0]) * len(self.parent)
+        max_depth = 0
+        for v in range(1, len(self.parent)):
+            depth[v] = depth[self.parent[v]] + 1
+            max_depth = max(max_depth, depth[v])
+        return max_depth
 
 def tangle_count_all(trees):
     """ This function applies a tangle counting function to every combination of trees
@@ -220,17 +908,76 @@ def tangle_count_all(trees):
     
 def tangle_count(a, b):
     """ This function computes a tangle count by counting the number of times a
-         pair of leaves in the left tree are in the opposite order in the right tree
+         pair of leaves in the left tree are in the opposite order in the right tree.
+         Only the taxa both trees share are counted, so adjacent means adjacent
+         among the shared leaves
     """
+    (a, b) = shared_orders(a, b)
     count = 0
     t = dict((b[i],i) for i in range(0,len(b)))
     
-    for i in range(1,min(len(a),len(b))):
-        try:
-            if t[a[i]] < t[a[i-1]]:
-                count += 1
-        except KeyError, e:
-            pass
+    for i in range(1,len(a)):
+        if t[a[i]] < t[a[i-1]]:
+            count += 1
+    return count
+
+def shared_orders(a, b):
+    """ This function restricts two leaf orders to the taxa they share,
+         so that the leaves only one tree has do not shift the positions of the others
+    """
+    sa = set(a)
+    sb = set(b)
+    if sa == sb:
+        return (a, b)
+    return ([x for x in a if x in sb], [x for x in b if x in sa])
+
+def crossing_count_all(trees):
+    """ This function counts the crossing lines over every combination of trees
+    """
+    l = [tr.leaves() for tr in trees.itervalues()]
+    count = 0
+    for (a,b) in itertools.combinations(l,2):
+        count = count + crossing_count(a,b)
+    return count
+
+def crossing_count(a, b):
+    """ This function computes the true number of crossing lines between two trees,
+         as drawn by tangle_render.draw_lines - the number of pairs of shared leaves
+         that are in the opposite order in the right tree. This is the number of
+         inversions in the right tree positions of the left tree leaves, which is
+         counted with a merge sort in O(n log n).
+    """
+    t = dict((b[i],i) for i in range(0,len(b)))
+    return inversion_count([t[x] for x in a if x in t])
+
+def inversion_count(seq):
+    """ This function counts the pairs i < j with seq[i] > seq[j], with a bottom-up
+         merge sort (iterative, so long sequences cannot exhaust the stack)
+    """
+    seq = list(seq)
+    n = len(seq)
+    buf = [0] * n
+    count = 0
+    width = 1
+    while width < n:
+        for lo in range(0, n, 2*width):
+            mid = min(lo + width, n)
+            hi = min(lo + 2*width, n)
+            i = lo
+            j = mid
+            k = lo
+            while i < mid and j < hi:
+                if seq[j] < seq[i]:
+                    buf[k] = seq[j]
+                    j += 1
+                    count += mid - i
+                else:
+                    buf[k] = seq[i]
+                    i += 1
+                k += 1
+            buf[k:hi] = seq[i:mid] + seq[j:hi]
+        seq, buf = buf, seq
+        width *= 2
     return count
 
 def flatness_count_all(trees):
@@ -242,15 +989,14 @@ def flatness_count_all(trees):
     return count
 
 def flatness_count(a, b):
-    """ This function computes an angle penalty """
+    """ This function computes an angle penalty, from the positions of the shared taxa
+         among the shared taxa """
+    (a, b) = shared_orders(a, b)
     count = 0
     t = dict((b[i],i) for i in range(0,len(b)))
     
-    for i in range(0,min(len(a),len(b))):
-        try:
-            count += abs(i-t[a[i]])
-        except KeyError, e:
-            pass       
+    for i in range(0,len(a)):
+        count += abs(i-t[a[i]])
     return count
 
 def alpha_count_all(trees):
@@ -259,11 +1005,871 @@ def alpha_count_all(trees):
     l = [tr.leaves() for tr in trees.itervalues()]
     count = 0
     for a in l:
-        for i  in range(1,len(a)-1):
-            if a[i] < a[i-1]:
+        count = count + alpha_count(a)
+    return count
+
+def alpha_count(a):
+    """ This function computes the alphabetizing penalty of a single tree """
+    count = 0
+    for i  in range(1,len(a)-1):
+        if a[i] < a[i-1]:
+            count += 1
+    return count
+
+def tangle_index_count(a, b, pb):
+    """ tangle_count for leaf orders of taxon ids, given the position index pb of b """
+    count = 0
+    for i in range(1,min(len(a),len(b))):
+        p = pb[a[i]]
+        q = pb[a[i-1]]
+        if p >= 0 and q >= 0 and p < q:
+            count += 1
+    return count
+
+def flatness_index_count(a, b, pb):
+    """ flatness_count for leaf orders of taxon ids, given the position index pb of b """
+    count = 0
+    for i in range(0,min(len(a),len(b))):
+        p = pb[a[i]]
+        if p >= 0:
+            count += abs(i-p)
+    return count
+
+def crossing_index_count(a, pb):
+    """ crossing_count for a leaf order of taxon ids, given the position index pb of b """
+    return inversion_count([pb[x] for x in a if pb[x] >= 0])
+
+def alpha_index_count(a, rank):
+    """ alpha_count for a leaf order of taxon ids, given the alphabetical rank of every id """
+    count = 0
+    for i  in range(1,len(a)-1):
+        if rank[a[i]] < rank[a[i-1]]:
+            count += 1
+    return count
+
+def flatness_index_delta(old, new, pold, pnew, other, po, lo, hi, first):
+    """ The change in flatness_index_count when positions lo to hi-1 of the leaf order of one
+    tree of the pair change from old to new (with position indexes pold and pnew). other and po
+    are the order and position index of the other tree, and first tells whether the changed
+    tree is the first argument of flatness_index_count """
+    m = min(len(new), len(other))
+    count = 0
+    if first:
+        for i in range(lo, min(hi, m)):
+            p = po[new[i]]
+            if p >= 0:
+                count += abs(i-p)
+            p = po[old[i]]
+            if p >= 0:
+                count -= abs(i-p)
+    else:
+        for x in new[lo:hi]:
+            i = po[x]
+            if i >= 0 and i < m:
+                count += abs(i-pnew[x]) - abs(i-pold[x])
+    return count
+
+def tangle_index_delta(old, new, pold, pnew, other, po, lo, hi, first):
+    """ The change in tangle_index_count, as in flatness_index_delta """
+    m = min(len(new), len(other))
+    count = 0
+    if first:
+        for i in range(max(lo, 1), min(hi + 1, m)):
+            p = po[new[i]]
+            q = po[new[i-1]]
+            if p >= 0 and q >= 0 and p < q:
                 count += 1
+            p = po[old[i]]
+            q = po[old[i-1]]
+            if p >= 0 and q >= 0 and p < q:
+                count -= 1
+    else:
+        touched = set()
+        for x in new[lo:hi]:
+            i = po[x]
+            if i >= 0:
+                touched.add(i)
+                touched.add(i+1)
+        for i in touched:
+            if i >= 1 and i < m:
+                p = pnew[other[i]]
+                q = pnew[other[i-1]]
+                if p >= 0 and q >= 0 and p < q:
+                    count += 1
+                p = pold[other[i]]
+                q = pold[other[i-1]]
+                if p >= 0 and q >= 0 and p < q:
+                    count -= 1
+    return count
+
+def crossing_index_delta(old, new, pold, pnew, other, po, lo, hi, first):
+    """ The change in crossing_index_count, as in flatness_index_delta. The leaves of the span
+    keep their order relative to every leaf outside it, so only the crossings among them change,
+    and those are the same whichever tree is first """
+    return inversion_count([po[x] for x in new[lo:hi] if po[x] >= 0]) - \
+        inversion_count([po[x] for x in old[lo:hi] if po[x] >= 0])
+
+def alpha_index_delta(old, new, rank, lo, hi):
+    """ The change in alpha_index_count when positions lo to hi-1 of a leaf order change
+    from old to new """
+    count = 0
+    for i in range(max(lo, 1), min(hi + 1, len(new) - 1)):
+        if rank[new[i]] < rank[new[i-1]]:
+            count += 1
+        if rank[old[i]] < rank[old[i-1]]:
+            count -= 1
     return count
 
+class position_matrix:
+    """ position_matrix: the NumPy scoring backend. It holds a K x L matrix of leaf orders
+         (taxon ids, padded with the sentinel id N) and a K x (N+1) matrix of taxon positions
+         (-1 for taxa absent from a tree), one row per tree, so that the penalties of many
+         pairs of trees are computed in a few broadcast operations. The numbers are the
+         same as those of the pure-Python functions.
+    """
+    components = ('flatness', 'tangle', 'crossing')
+
+    def __init__(self, orders, size):
+        """ orders is a list of leaf orders, or an array of orders of the same length """
+        self.size = size
+        if isinstance(orders, numpy.ndarray):
+            (k, n) = orders.shape
+            self.order = orders.astype(numpy.int64)
+            self.pos = numpy.full((k, size + 1), -1, dtype=numpy.int64)
+            self.pos[numpy.arange(k)[:, None], self.order] = numpy.arange(n)[None, :]
+            self.length = numpy.full(k, n, dtype=numpy.int64)
+            return
+        width = max([len(x) for x in orders] + [1])
+        self.order = numpy.empty((len(orders), width), dtype=numpy.int64)
+        self.pos = numpy.empty((len(orders), size + 1), dtype=numpy.int64)
+        self.length = numpy.zeros(len(orders), dtype=numpy.int64)
+        for k in range(0, len(orders)):
+            self.set_row(k, orders[k])
+
+    def set_row(self, k, order):
+        o = numpy.array(order, dtype=numpy.int64)
+        n = len(o)
+        self.order[k, :n] = o
+        self.order[k, n:] = self.size
+        self.pos[k, :] = -1
+        self.pos[k, o] = numpy.arange(n)
+        self.length[k] = n
+
+    def get_row(self, k):
+        return (self.order[k].copy(), self.pos[k].copy(), self.length[k])
+
+    def put_row(self, k, row):
+        (self.order[k], self.pos[k], self.length[k]) = row
+
+    def pair_components(self, left, right, components, timings=None):
+        """ The values of the named pairwise components ('flatness', 'tangle', 'crossing')
+        of the pairs (left[i], right[i]) of row numbers, as a dict of arrays. The time spent
+        on each is added to timings, and the time spent gathering positions to 'layout' """
+        start = time.time()
+        left = numpy.asarray(left, dtype=numpy.int64)
+        right = numpy.asarray(right, dtype=numpy.int64)
+        a = self.order[left]
+        pb = self.pos[right[:, None], a]
+        col = numpy.arange(a.shape[1])
+        inside = col[None, :] < numpy.minimum(self.length[left], self.length[right])[:, None]
+        if not timings is None:
+            timings['layout'] += time.time() - start
+        return self.penalties(pb, inside, components, timings)
+
+    def candidate_components(self, candidates, first, second, components, timings=None):
+        """ The values of the named pairwise components between every row of candidates (a
+        position_matrix of leaf orders of one tree, e.g. for different twists) and the trees
+        of this matrix, as a dict of arrays with one row per candidate: the pairs with rows
+        first (the candidate tree first in the pair) come first, then those with rows second.
+        All the candidates and pairs are scored in the same broadcast operations """
+        start = time.time()
+        m = candidates.order.shape[0]
+        first = numpy.asarray(first, dtype=numpy.int64)
+        second = numpy.asarray(second, dtype=numpy.int64)
+        """ pb[j, i, x]: for pair j and candidate i, the position in the second tree of the
+        leaf at x in the first """
+        pb1 = self.pos[first[:, None, None], candidates.order[None, :, :]]
+        a2 = self.order[second]
+        pb2 = candidates.pos[numpy.arange(m)[None, :, None], a2[:, None, :]]
+        width = max(pb1.shape[2], pb2.shape[2])
+        pb = numpy.full((len(first) + len(second), m, width), -1, dtype=numpy.int64)
+        pb[:len(first), :, :pb1.shape[2]] = pb1
+        pb[len(first):, :, :pb2.shape[2]] = pb2
+        length = numpy.minimum(self.length[numpy.concatenate([first, second])][:, None],
+            candidates.length[None, :])
+        pb = pb.reshape(-1, width)
+        inside = numpy.arange(width)[None, :] < length.reshape(-1, 1)
+        if not timings is None:
+            timings['layout'] += time.time() - start
+        values = self.penalties(pb, inside, components, timings)
+        return dict((c, v.reshape(-1, m).T) for (c, v) in values.iteritems())
+
+    def penalties(self, pb, inside, components, timings=None):
+        """ The named pairwise components of the pairs of leaf orders given as rows of pb
+        (the positions in the second order of the leaves of the first, -1 where absent) and
+        inside (the columns within both orders) """
+        col = numpy.arange(pb.shape[1])
+        present = pb >= 0
+        values = {}
+        for c in components:
+            start = time.time()
+            if c == 'flatness':
+                values[c] = numpy.where(inside & present, numpy.abs(col[None, :] - pb), 0).sum(1)
+            elif c == 'crossing':
+                values[c] = numpy.array([inversion_count(row[row >= 0].tolist()) for row in pb],
+                    dtype=numpy.int64)
+            elif c == 'tangle':
+                values[c] = (present[:, 1:] & present[:, :-1] & (pb[:, 1:] < pb[:, :-1]) &
+                    inside[:, 1:]).sum(1)
+            if not timings is None:
+                timings[c] += time.time() - start
+        return values
+
+    def alpha_counts(self, rank):
+        """ The alphabetizing penalty of every row, given the alphabetical rank of every id """
+        r = numpy.append(numpy.array(rank, dtype=numpy.int64), -1)[self.order]
+        col = numpy.arange(1, self.order.shape[1])
+        inside = col[None, :] < (self.length - 1)[:, None]
+        return ((r[:, 1:] < r[:, :-1]) & inside).sum(1)
+
+class component:
+    """ component: a named term of the value minimized. A 'pair' component is a penalty of a
+         pair of trees, computed as function(a, b, pb) from the leaf orders a and b (as taxon
+         ids) and the position index pb of b; a 'tree' component is a penalty of one tree,
+         computed as function(a, rank) from its leaf order and the alphabetical rank of every
+         id. The scorer caches both and recomputes only those touched by a move.
+         The optional delta gives the change of the value when only a range of positions of
+         one leaf order changed, as flatness_index_delta does for a 'pair' component and
+         alpha_index_delta for a 'tree' component, so that small moves cost O(range).
+    """
+    def __init__(self, name, kind, function, delta=None):
+        if not kind in ('pair', 'tree'):
+            raise ValueError("component kind must be 'pair' or 'tree', not " + repr(kind))
+        self.name = name
+        self.kind = kind
+        self.function = function
+        self.delta = delta
+
+g_components = {}
+
+def register_component(name, kind, function, delta=None):
+    """ Make a component available to the objective under _name_, e.g.
+    register_component('ends', 'pair', lambda a, b, pb: int(pb[a[0]] != 0)) """
+    g_components[name] = component(name, kind, function, delta)
+
+register_component('flatness', 'pair', flatness_index_count, flatness_index_delta)
+register_component('tangle', 'pair', tangle_index_count, tangle_index_delta)
+register_component('crossing', 'pair', lambda a, b, pb: crossing_index_count(a, pb),
+    crossing_index_delta)
+register_component('alpha', 'tree', alpha_index_count, alpha_index_delta)
+
+def objective_weights(objective=None, weights=None):
+    """ The weight of every component: 1 for 'flatness' and the objective, 0.5 for 'alpha',
+    updated with g_weights and then with weights """
+    if objective is None:
+        objective = g_objective
+    w = {'flatness': 1, objective: 1, 'alpha': 0.5}
+    w.update(g_weights)
+    if not weights is None:
+        w.update(weights)
+    for c in w:
+        if not c in g_components:
+            raise ValueError("unknown objective component: " + str(c))
+    return w
+
+def pair_weight(pair_weights, a, b):
+    """ The weight of the pair of trees named a and b: the first of (a, b), (a, '*'),
+    ('*', '*') found in pair_weights (in either order), or 1 """
+    for key in ((a, b), (b, a), (a, '*'), ('*', a), (b, '*'), ('*', b), ('*', '*')):
+        if key in pair_weights:
+            return pair_weights[key]
+    return 1
+
+class scorer:
+    """ scorer: this class caches the leaf order and position index of every tree, and the
+         value of every component of the objective - by default the pairwise flatness and
+         tangling (objective) penalties of every pair of trees, and the alphabetizing penalty
+         of every tree - so that after the twists of a single tree are changed only the pairs
+         involving that tree need to be re-scored. Leaves are compared as taxon ids, using
+         the table the trees were loaded with when they share one. With use_numpy the
+         built-in pairwise components are scored through a position_matrix. The totals are
+         the same as those returned by the pure-Python minimize_this.
+
+         weights and pair_weights are as g_weights and g_pair_weights (see objective_weights
+         and pair_weight); components and pairs of weight 0 are never computed. With an
+         anchor (the name of one of the trees) only the pairs including it are scored.
+
+         With sample, update only re-scores that many of the pairs involving the tree,
+         picked at random, and returns the total extrapolated from them. The other pairs
+         are left stale until refresh() re-scores them and returns the exact total.
+
+         The last cache_size layouts scored are remembered in an LRU cache keyed by tree and
+         canonical twists, with their leaf order, per-tree values, and pair values (valid
+         while the partner tree is still in the layout it was scored against), so that a
+         layout seen again is not rebuilt or re-scored.
+
+         Call update(name) after applying new twists to trees[name], then either accept()
+         to keep the new values, or reject() to restore the cached ones (after restoring
+         the old twists on the tree). Passing update the range of positions apply_twists
+         reports as changed lets the components with a delta be updated in proportion to
+         the size of the range, instead of the size of the trees.
+
+         totals holds the current (pair weighted) total of every component, timings the seconds spent on
+         each (and on 'layout', the leaf orders and positions), evaluations the number
+         of updates made, and hits the number of those answered from the cache.
+    """
+    def __init__(self, trees, objective=None, use_numpy=None, weights=None, pair_weights=None,
+        cache_size=None, anchor=None, sample=None):
+        if objective is None:
+            objective = g_objective
+        if use_numpy is None:
+            use_numpy = g_use_numpy
+        if pair_weights is None:
+            pair_weights = g_pair_weights
+        if cache_size is None:
+            cache_size = g_cache_size
+        self.trees = trees
+        self.objective = objective
+        self.names = trees.keys()
+        self.weights = objective_weights(objective, weights)
+        used = sorted(c for c in self.weights if self.weights[c] != 0)
+        self.pair_components = [c for c in used if g_components[c].kind == 'pair']
+        self.tree_components = [c for c in used if g_components[c].kind == 'tree']
+        self.timings = dict((c, 0.0) for c in ['layout'] + self.pair_components + self.tree_components)
+        self.evaluations = 0
+        self.hits = 0
+        self.sample = sample
+        self.stale = set()
+        self.marked = ([], [])
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.key = dict((k, tuple(trees[k].get_twists())) for k in self.names)
+        tables = set(id(getattr(tr, 'taxa', None)) for tr in trees.itervalues())
+        if len(tables) == 1 and not getattr(trees[self.names[0]], 'taxa', None) is None:
+            self.taxa = trees[self.names[0]].taxa
+        else:
+            self.taxa = taxon_table()
+        self.order = dict((k, trees[k].leaf_taxa(self.taxa)[:]) for k in self.names)
+        self.pos = dict((k, self.positions(k, self.order[k])) for k in self.names)
+        self.rank = self.taxa.ranks()
+        self.partners = dict((k, []) for k in self.names)
+        self.pair_weight = {}
+        for (a,b) in itertools.combinations(self.names,2):
+            w = pair_weight(pair_weights, a, b)
+            if w != 0 and (anchor is None or anchor == a or anchor == b):
+                self.pair_weight[(a,b)] = w
+        combos = [p for p in itertools.combinations(self.names,2) if p in self.pair_weight]
+        for (a,b) in combos:
+            self.partners[a].append((a,b))
+            self.partners[b].append((a,b))
+        """ The pairs whose trees do not hold the same taxa are scored on their leaf orders
+        restricted to the shared taxa: mask[pair] flags the shared taxon ids, and
+        restricted[(pair, name)] holds the restricted order and position index of a tree """
+        self.mask = {}
+        self.restricted = {}
+        members = dict((k, frozenset(self.order[k])) for k in self.names)
+        for (a,b) in combos:
+            if members[a] != members[b]:
+                mask = array('b', [0]) * len(self.taxa)
+                for x in members[a] & members[b]:
+                    mask[x] = 1
+                self.mask[(a,b)] = mask
+                for k in (a,b):
+                    self.restricted[((a,b), k)] = self.restrict((a,b), self.order[k])
+        self.saved_restricted = []
+        self.partner_weight = dict((k, sum(self.pair_weight[p] for p in self.partners[k]))
+            for k in self.names)
+        self.matrix = None
+        if use_numpy and not numpy is None:
+            self.row = dict((self.names[i], i) for i in range(0, len(self.names)))
+            self.matrix = position_matrix([self.order[k] for k in self.names], len(self.taxa))
+        self.values = {}
+        pairs = self.score_pairs(combos)
+        for c in self.pair_components:
+            self.values[c] = dict(zip(combos, pairs[c]))
+        for c in self.tree_components:
+            self.values[c] = {}
+        for k in self.names:
+            for (c, v) in self.score_tree(self.order[k]).iteritems():
+                self.values[c][k] = v
+        self.totals = dict((c, sum(self.values[c].itervalues())) for c in self.tree_components)
+        for c in self.pair_components:
+            self.totals[c] = sum(self.pair_weight[p] * v for (p, v) in self.values[c].iteritems())
+        self.saved = None
+
+    def positions(self, name, order):
+        """ The position index of trees[name], a copy the tree will not update """
+        tr = self.trees[name]
+        if getattr(tr, 'taxa', None) is self.taxa:
+            return tr.positions()[:]
+        return position_index(order, len(self.taxa))
+
+    def restrict(self, pair, order):
+        """ A leaf order restricted to the taxa shared by the pair, and its position index """
+        mask = self.mask[pair]
+        shared = array('i', [x for x in order if mask[x]])
+        return (shared, position_index(shared, len(self.taxa)))
+
+    def restrict_span(self, pair, name, order, span):
+        """ The restricted order and position index of trees[name] in the pair after the
+        positions span[0] to span[1]-1 of its leaf order changed, with the range they cover in
+        the restricted order. A twist keeps the taxa of the span together, so only that range
+        is rewritten """
+        (old, pold) = self.restricted[(pair, name)]
+        mask = self.mask[pair]
+        block = [x for x in order[span[0]:span[1]] if mask[x]]
+        if len(block) == 0:
+            return (old, pold, (0, 0))
+        lo = min(pold[x] for x in block)
+        new = old[:]
+        pnew = pold[:]
+        new[lo:lo + len(block)] = array('i', block)
+        for i in range(0, len(block)):
+            pnew[block[i]] = lo + i
+        return (new, pnew, (lo, lo + len(block)))
+
+    def operands(self, pair):
+        """ The leaf orders of the pair, and the position index of the second,
+        restricted to the shared taxa when the trees do not hold the same taxa """
+        (a, b) = pair
+        if pair in self.mask:
+            return (self.restricted[(pair, a)][0],) + self.restricted[(pair, b)]
+        return (self.order[a], self.order[b], self.pos[b])
+
+    def score_pairs(self, pairs, components=None):
+        """ The values of the pairwise components for a list of pairs of tree names """
+        if components is None:
+            components = self.pair_components
+        if len(pairs) == 0:
+            return dict((c, []) for c in components)
+        values = dict((c, [None] * len(pairs)) for c in components)
+        rest = components
+        if not self.matrix is None:
+            """ The position matrix holds the whole leaf orders, so it only scores
+            the pairs over the same taxa """
+            vectorized = [c for c in rest if c in position_matrix.components]
+            whole = [i for i in range(0, len(pairs)) if not pairs[i] in self.mask]
+            if len(vectorized) > 0 and len(whole) > 0:
+                scores = self.matrix.pair_components([self.row[pairs[i][0]] for i in whole],
+                    [self.row[pairs[i][1]] for i in whole], vectorized, self.timings)
+                for (c, v) in scores.iteritems():
+                    for (i, x) in zip(whole, v.tolist()):
+                        values[c][i] = x
+                if len(whole) == len(pairs):
+                    rest = [c for c in rest if not c in position_matrix.components]
+        for c in rest:
+            start = time.time()
+            f = g_components[c].function
+            if len(self.mask) == 0:
+                values[c] = [f(self.order[a], self.order[b], self.pos[b]) for (a,b) in pairs]
+            else:
+                values[c] = [f(*self.operands(p)) if v is None else v for (p, v) in zip(pairs, values[c])]
+            self.timings[c] += time.time() - start
+        return values
+
+    def score_tree(self, order):
+        """ The values of the per-tree components for one tree, given its leaf order """
+        values = {}
+        for c in self.tree_components:
+            start = time.time()
+            values[c] = g_components[c].function(order, self.rank)
+            self.timings[c] += time.time() - start
+        return values
+
+    def total(self):
+        t = 0
+        for c in self.pair_components + self.tree_components:
+            t = t + self.totals[c] * self.weights[c]
+        return t
+
+    def cached(self, name, key, span):
+        """ The cache entry of trees[name] in the layout with canonical twists key:
+        [leaf order, positions, per-tree values, {pair: (partner key, pair values)}].
+        A new entry is scored relative to the current one when span is given """
+        entry = self.cache.pop((name, key), None)
+        if entry is None:
+            start = time.time()
+            order = self.trees[name].leaf_taxa(self.taxa)[:]
+            pos = self.positions(name, order)
+            self.timings['layout'] += time.time() - start
+            if span is None:
+                values = self.score_tree(order)
+            else:
+                values = {}
+                old = self.order[name]
+                for c in self.tree_components:
+                    start = time.time()
+                    delta = g_components[c].delta
+                    if delta is None:
+                        values[c] = g_components[c].function(order, self.rank)
+                    else:
+                        values[c] = self.values[c][name] + delta(old, order, self.rank, span[0], span[1])
+                    self.timings[c] += time.time() - start
+            entry = [order, pos, values, {}]
+            if self.cache_size > 0 and len(self.cache) >= self.cache_size:
+                self.cache.popitem(False)
+        else:
+            self.hits += 1
+        if self.cache_size > 0:
+            self.cache[(name, key)] = entry
+        return entry
+
+    def update(self, name, span=None):
+        """ Re-score only the pairs involving trees[name], and return the new total.
+        span is the (lo, hi) range of its leaf order that changed since the last update, if
+        known (it has to be relative to the order the scorer last saw) """
+        partners = self.partners[name]
+        unsampled = []
+        if not self.sample is None and len(partners) > self.sample:
+            chosen = random.sample(partners, self.sample)
+            picked = set(chosen)
+            unsampled = [p for p in partners if not p in picked]
+            partners = chosen
+        self.saved = (name, self.order[name], self.pos[name], self.key[name],
+            [(c, name, self.values[c][name]) for c in self.tree_components] +
+            [(c, p, self.values[c][p]) for c in self.pair_components for p in partners],
+            dict(self.totals),
+            None if self.matrix is None else self.matrix.get_row(self.row[name]))
+        self.evaluations += 1
+        key = tuple(self.trees[name].get_twists())
+        (old, pold) = (self.order[name], self.pos[name])
+        if not span is None and span[1] - span[0] > len(old) / (2 if self.matrix is None else 16):
+            """ The deltas go over the range twice, and are not vectorized, so past this
+            it is cheaper to score the new order afresh """
+            span = None
+        (order, pos, tree_values, pair_values) = self.cached(name, key, span)
+        self.key[name] = key
+        self.order[name] = order
+        self.pos[name] = pos
+        if not self.matrix is None:
+            start = time.time()
+            self.matrix.set_row(self.row[name], order)
+            self.timings['layout'] += time.time() - start
+        for (c, v) in tree_values.iteritems():
+            self.totals[c] += v - self.values[c][name]
+            self.values[c][name] = v
+        """ The restricted orders follow the twist even when the pair values come from the
+        cache. A stale pair may have missed twists of either tree, so it is restricted afresh """
+        self.saved_restricted = []
+        spans = {}
+        for p in partners:
+            if p in self.mask:
+                if span is None or p in self.stale:
+                    for k in p:
+                        self.saved_restricted.append(((p, k), self.restricted[(p, k)]))
+                        self.restricted[(p, k)] = self.restrict(p, self.order[k])
+                else:
+                    saved = self.restricted[(p, name)]
+                    self.saved_restricted.append(((p, name), saved))
+                    (shared, spos, shared_span) = self.restrict_span(p, name, order, span)
+                    self.restricted[(p, name)] = (shared, spos)
+                    spans[p] = saved + shared_span
+        other = dict((p, p[1] if p[0] == name else p[0]) for p in partners)
+        todo = [p for p in partners
+            if not p in pair_values or pair_values[p][0] != self.key[other[p]]]
+        """ A delta needs the value for the old order, which a stale pair does not have """
+        whole = todo
+        by_delta = []
+        full = self.pair_components
+        if not span is None:
+            whole = [p for p in todo if p in self.stale]
+            by_delta = [p for p in todo if not p in self.stale]
+            full = [c for c in full if g_components[c].delta is None]
+        scores = self.score_pairs(whole)
+        for i in range(0, len(whole)):
+            pair_values[whole[i]] = (self.key[other[whole[i]]],
+                dict((c, scores[c][i]) for c in self.pair_components))
+        scores = self.score_pairs(by_delta, full)
+        for i in range(0, len(by_delta)):
+            p = by_delta[i]
+            o = other[p]
+            values = dict((c, scores[c][i]) for c in full)
+            if p in spans:
+                (sold, spold, lo, hi) = spans[p]
+                operands = (sold, self.restricted[(p, name)][0], spold, self.restricted[(p, name)][1]) + \
+                    self.restricted[(p, o)] + (lo, hi)
+            else:
+                operands = (old, order, pold, pos, self.order[o], self.pos[o], span[0], span[1])
+            for c in self.pair_components:
+                if not c in values:
+                    start = time.time()
+                    values[c] = self.values[c][p] + g_components[c].delta(*(operands + (p[0] == name,)))
+                    self.timings[c] += time.time() - start
+            pair_values[p] = (self.key[o], values)
+        change = 0
+        for p in partners:
+            w = self.pair_weight[p]
+            for (c, v) in pair_values[p][1].iteritems():
+                self.totals[c] += w * (v - self.values[c][p])
+                change += self.weights[c] * w * (v - self.values[c][p])
+                self.values[c][p] = v
+        if len(unsampled) == 0:
+            self.marked = ([], [])
+            return self.total()
+        self.marked = ([p for p in unsampled if not p in self.stale],
+            [p for p in partners if p in self.stale])
+        self.stale.update(self.marked[0])
+        self.stale.difference_update(self.marked[1])
+        scored = sum(self.pair_weight[p] for p in partners)
+        return self.total() + change * (self.partner_weight[name] - scored) / float(scored)
+
+    def score_candidates(self, name, candidates):
+        """ The totals the scorer would return with trees[name] twisted to each of the
+        candidates (lists of twists), without changing its state or that of the tree. All the
+        leaf orders are laid out first (at once with twisted_orders, when NumPy is used and the
+        tree has it), and with NumPy all the pairs of all the candidates are then scored in one
+        vectorized pass (the pairs of trees that do not hold the same taxa, and components
+        NumPy does not compute, are scored one by one) """
+        tr = self.trees[name]
+        start = time.time()
+        candidate_matrix = None
+        if not self.matrix is None and hasattr(tr, 'twisted_orders') \
+            and getattr(tr, 'taxa', None) is self.taxa:
+            candidate_matrix = position_matrix(tr.twisted_orders(candidates), len(self.taxa))
+            orders = None
+        else:
+            current = tr.get_twists()
+            orders = []
+            for t in candidates:
+                tr.apply_twists(t)
+                orders.append(tr.leaf_taxa(self.taxa)[:])
+            tr.apply_twists(current)
+        self.timings['layout'] += time.time() - start
+        self.evaluations += len(candidates)
+        change = [0.0] * len(candidates)
+        tree_components = self.tree_components
+        if not candidate_matrix is None and 'alpha' in tree_components:
+            start = time.time()
+            delta = (self.weights['alpha'] * (candidate_matrix.alpha_counts(self.rank) -
+                self.values['alpha'][name])).tolist()
+            for i in range(0, len(candidates)):
+                change[i] += delta[i]
+            tree_components = [c for c in tree_components if c != 'alpha']
+            self.timings['alpha'] += time.time() - start
+        if orders is None and (len(tree_components) > 0 or any(p in self.mask for p in self.partners[name])
+            or any(not c in position_matrix.components for c in self.pair_components)):
+            orders = candidate_matrix.order.tolist()
+        for c in tree_components:
+            start = time.time()
+            f = g_components[c].function
+            w = self.weights[c]
+            old = self.values[c][name]
+            for i in range(0, len(orders)):
+                change[i] += w * (f(orders[i], self.rank) - old)
+            self.timings[c] += time.time() - start
+        partners = self.partners[name]
+        rest = dict((p, self.pair_components) for p in partners)
+        whole = [p for p in partners if not p in self.mask]
+        vectorized = [c for c in self.pair_components if c in position_matrix.components]
+        if not self.matrix is None and len(whole) > 0 and len(vectorized) > 0:
+            if candidate_matrix is None:
+                start = time.time()
+                candidate_matrix = position_matrix(orders, len(self.taxa))
+                self.timings['layout'] += time.time() - start
+            pairs = [p for p in whole if p[0] == name] + [p for p in whole if p[0] != name]
+            scores = self.matrix.candidate_components(candidate_matrix,
+                [self.row[p[1]] for p in pairs if p[0] == name],
+                [self.row[p[0]] for p in pairs if p[0] != name], vectorized, self.timings)
+            for c in vectorized:
+                w = self.weights[c]
+                old = numpy.array([self.pair_weight[p] * self.values[c][p] for p in pairs])
+                weights = numpy.array([self.pair_weight[p] for p in pairs], dtype=float)
+                delta = (w * (numpy.dot(scores[c], weights) - old.sum())).tolist()
+                for i in range(0, len(candidates)):
+                    change[i] += delta[i]
+            left = [c for c in self.pair_components if not c in vectorized]
+            for p in whole:
+                rest[p] = left
+        positions = [None] * len(candidates)
+        for p in partners:
+            if len(rest[p]) == 0:
+                continue
+            o = p[1] if p[0] == name else p[0]
+            if p in self.mask:
+                (other, po) = self.restrict(p, self.order[o])
+                operands = [self.restrict(p, x) for x in orders]
+            else:
+                (other, po) = (self.order[o], self.pos[o])
+                for i in range(0, len(orders)):
+                    if positions[i] is None:
+                        positions[i] = position_index(orders[i], len(self.taxa))
+                operands = zip(orders, positions)
+            for c in rest[p]:
+                start = time.time()
+                f = g_components[c].function
+                w = self.weights[c] * self.pair_weight[p]
+                old = self.values[c][p]
+                for i in range(0, len(orders)):
+                    (order, pos) = operands[i]
+                    if p[0] == name:
+                        v = f(order, other, po)
+                    else:
+                        v = f(other, order, pos)
+                    change[i] += w * (v - old)
+                self.timings[c] += time.time() - start
+        total = self.total()
+        return [total + x for x in change]
+
+    def refresh(self):
+        """ Re-score the pairs left stale by sampled updates, and return the exact total """
+        pairs = list(self.stale)
+        for p in pairs:
+            if p in self.mask:
+                for k in p:
+                    self.restricted[(p, k)] = self.restrict(p, self.order[k])
+        scores = self.score_pairs(pairs)
+        for c in self.pair_components:
+            values = self.values[c]
+            for i in range(0, len(pairs)):
+                self.totals[c] += self.pair_weight[pairs[i]] * (scores[c][i] - values[pairs[i]])
+                values[pairs[i]] = scores[c][i]
+        self.stale = set()
+        return self.total()
+
+    def get_stale(self):
+        """ The stale pairs with the values kept for them, to checkpoint a sampled run """
+        return dict((p, dict((c, self.values[c][p]) for c in self.pair_components))
+            for p in self.stale)
+
+    def set_stale(self, stale):
+        """ Make pairs stale again with the values get_stale returned for them, so that a
+        resumed sampled run scores exactly as the original one did """
+        for (p, values) in stale.iteritems():
+            for (c, v) in values.iteritems():
+                self.totals[c] += self.pair_weight[p] * (v - self.values[c][p])
+                self.values[c][p] = v
+            self.stale.add(p)
+
+    def accept(self):
+        self.saved = None
+
+    def reject(self):
+        """ Restore the values cached before the last update, without recomputing anything """
+        if self.saved is None:
+            return
+        (name, order, pos, self.key[name], values, self.totals, row) = self.saved
+        (added, cleared) = self.marked
+        self.stale.difference_update(added)
+        self.stale.update(cleared)
+        if not row is None:
+            self.matrix.put_row(self.row[name], row)
+        self.order[name] = order
+        self.pos[name] = pos
+        for (c, key, v) in values:
+            self.values[c][key] = v
+        for (k, v) in self.saved_restricted:
+            self.restricted[k] = v
+        self.saved = None
+
+class fixed_order(object):
+    """ fixed_order: a leaf order that cannot be twisted, such as a consensus of the trees,
+         with the part of the tree interface the scorer needs, to anchor the trees to.
+    """
+    def __init__(self, name, leaves, taxa=None):
+        if taxa is None:
+            taxa = g_taxa
+        self.name = name
+        self.taxa = taxa
+        self.names = list(leaves)
+        self.order = array('i', (taxa.intern(x) for x in self.names))
+
+    def leaves(self):
+        return list(self.names)
+
+    def leaf_taxa(self, taxa=None):
+        if not taxa is None and not taxa is self.taxa:
+            return array('i', (taxa.intern(x) for x in self.names))
+        return self.order
+
+    def positions(self, taxa=None):
+        if taxa is None:
+            taxa = self.taxa
+        return position_index(self.leaf_taxa(taxa), len(taxa))
+
+    def get_twists(self):
+        return []
+
+    def twist_sizes(self):
+        return []
+
+    def apply_twists(self, twists):
+        return None
+
+def consensus_order(tree_list):
+    """ Every taxon of the trees, ordered by its mean relative position in the trees holding it """
+    total = {}
+    count = {}
+    for tr in tree_list:
+        leaves = list(tr.leaves())
+        scale = float(max(len(leaves) - 1, 1))
+        for i in range(0, len(leaves)):
+            total[leaves[i]] = total.get(leaves[i], 0.0) + i / scale
+            count[leaves[i]] = count.get(leaves[i], 0) + 1
+    return sorted(total.keys(), key=lambda x: (total[x] / count[x], x))
+
+class progress_reporter:
+    """ progress_reporter: the default observer of process_trees. It prints a status line
+         at most once every _interval_ seconds, and once at the end, using only the values
+         process_trees hands it, so reporting costs no extra evaluations.
+    """
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = g_report_interval
+        self.interval = interval
+        self.last = 0
+
+    def __call__(self, progress):
+        now = time.time()
+        if not progress['finished'] and now - self.last < self.interval:
+            return
+        self.last = now
+        components = progress['components']
+        print "Iteration " + str(progress['iteration']) + ", Intensity " + str(progress['intensity']) + \
+            ", Optimize " + str(progress['best']) + \
+            "".join(", " + c.capitalize() + " " + str(components[c]) for c in sorted(components)) + \
+            ", Accepted " + str(progress['accepted']) + "/" + str(progress['tried']) + \
+            ", " + ("%.1f" % progress['evaluations_per_second']) + " evaluations/s (" + \
+            ", ".join(c + " " + ("%.2f" % t) + "s" for (c, t) in sorted(progress['timings'].iteritems())) + ")"
+
+class acceptance_schedule:
+    """ acceptance_schedule: the adaptive schedule of process_trees. It counts the moves
+         accepted out of every _window_ tried, and raises the intensity by _step_ when more
+         than _target_ of them were accepted, or lowers it when fewer were, so that the
+         moves stay as large as the trees can still take.
+    """
+    def __init__(self, intensity, target=None, window=None, step=None):
+        self.target = g_target_acceptance if target is None else target
+        self.window = g_adapt_window if window is None else window
+        self.step = g_adapt_step if step is None else step
+        self.maximum = max(1, intensity)
+        self.level = float(self.maximum)
+        self.accepted = 0
+        self.tried = 0
+
+    def intensity(self):
+        return max(1, int(round(self.level)))
+
+    def record(self, accepted):
+        """ Count one move tried, and return the intensity to use next """
+        self.tried += 1
+        if accepted:
+            self.accepted += 1
+        if self.tried >= self.window:
+            rate = self.accepted / float(self.tried)
+            if rate > self.target:
+                self.level = min(self.maximum, self.level * self.step)
+            elif rate < self.target:
+                self.level = max(1.0, self.level / self.step)
+            self.accepted = 0
+            self.tried = 0
+        return self.intensity()
+
+    def get_state(self):
+        return (self.level, self.accepted, self.tried)
+
+    def set_state(self, state):
+        (self.level, self.accepted, self.tried) = state
+
 def write(filename, tree_list):
     with open(filename, 'w') as f:
         f.write("#NEXUS \n\n\n")
@@ -273,23 +1879,420 @@ def write(filename, tree_list):
             f.write("\n\n")
         f.write("end;\n")
 
-def minimize_this(trees):
+class checkpointer:
+    """ checkpointer: writes checkpoints of process_trees from a background thread, at most
+         once every _interval_ seconds, so that the optimizer is never held up by I/O.
+         Only the most recently submitted state is kept; older ones are dropped unwritten.
+         A checkpoint is the current result as a NEXUS file, and the whole optimizer state
+         (see process_trees) pickled to checkpoint_filename, each replaced atomically.
+         close() writes any pending state before returning.
+    """
+    def __init__(self, tree_list, output_filename, checkpoint_filename=None,
+        interval=g_checkpoint_interval):
+        if checkpoint_filename is None:
+            checkpoint_filename = output_filename + '.ckpt'
+        """ The writer twists its own compact copies of the trees, never the ones being
+        optimized; building them is iterative, so deep trees do not hit the recursion limit """
+        self.trees = shared_compact(tree_list, taxon_table())
+        self.output_filename = output_filename
+        self.checkpoint_filename = checkpoint_filename
+        self.interval = interval
+        self.last = 0
+        self.pending = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def due(self):
+        return time.time() - self.last >= self.interval
+
+    def submit(self, state):
+        with self.condition:
+            self.pending = state
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                wait = self.interval - (time.time() - self.last)
+                if wait > 0 and not self.closed:
+                    self.condition.wait(wait)
+                    continue
+                state = self.pending
+                self.pending = None
+            self.write(state)
+
+    def write(self, state):
+        self.last = time.time()
+        for tr in self.trees:
+            tr.apply_twists(state['twists'][tr.name])
+        write(self.output_filename + '.tmp', self.trees)
+        os.rename(self.output_filename + '.tmp', self.output_filename)
+        with open(self.checkpoint_filename + '.tmp', 'wb') as f:
+            pickle.dump(state, f, 2)
+        os.rename(self.checkpoint_filename + '.tmp', self.checkpoint_filename)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+def load_checkpoint(filename):
+    """ Read an optimizer state written by a checkpointer, to pass to process_trees(resume=...) """
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+def minimize_this(trees, objective=None, weights=None, pair_weights=None):
     """ This function needs to return a value to be minimized.
-    tangle_count_all counts the crossings
+    tangle_count_all counts the adjacent leaves that flip order (a cheap proxy for crossings)
+    crossing_count_all counts the actual crossing lines
     alpha_count_all counts the alphabetic ordering failures
-    you can use either or both, and you can multiply the returned
-    values to adjust the importance of alphabetizing vs. tangling
-    or you can add your own measure to be minimized. """
+    objective selects 'tangle' (the proxy) or 'crossing' for the tangling measure
+    weights and pair_weights (or g_weights and g_pair_weights) adjust the importance
+    of alphabetizing vs. tangling, of each pair of trees, or of your own measures
+    added with register_component; the value is then computed by a scorer.
+    When g_use_numpy is set, the same value is computed by the vectorized backend. """
+    if objective is None:
+        objective = g_objective
+    if g_use_numpy and not numpy is None or weights or pair_weights or g_weights or g_pair_weights:
+        return scorer(trees, objective, g_use_numpy, weights, pair_weights).total()
     #return tangle_count_all() + (alpha_count_all()*0.5)
+    if objective == 'crossing':
+        return flatness_count_all(trees) + crossing_count_all(trees)  + (alpha_count_all(trees)*0.5)
     return flatness_count_all(trees) + tangle_count_all(trees)  + (alpha_count_all(trees)*0.5)
 
+def block_crossings(a, b):
+    """ The number of crossings between two sorted lists of reference positions when
+    the block a is placed before the block b, i.e. the pairs with x in a greater than y in b """
+    count = 0
+    if len(a) <= len(b):
+        for x in a:
+            count += bisect.bisect_left(b, x)
+    else:
+        for y in b:
+            count += len(a) - bisect.bisect_right(a, y)
+    return count
+
+def one_sided_twists(tr, reference):
+    """ The twists of tr giving the fewest crossing lines to the fixed leaf order reference
+    (a list of names). The crossings between the subtrees of a node only depend on the
+    rotation of that node, so working bottom-up and taking the best rotation of every node
+    (among all of them, for multifurcations) is exact. Leaves missing from the reference
+    are ignored """
+    if not isinstance(tr, compact_tree):
+        ct = compact_tree(taxa=taxon_table())
+        ct.init_from_tree(tr)
+        tr = ct
+    where = dict((reference[i], i) for i in range(0, len(reference)))
+    names = tr.taxa.names
+    offset = tr.offset
+    child = tr.child
+    taxon = tr.taxon
+    twist = tr.twist
+    twists = {}
+    blocks = [None] * len(tr.parent)
+    for v in range(len(tr.parent) - 1, -1, -1):
+        lo = offset[v]
+        k = offset[v + 1] - lo
+        if k == 0:
+            p = where.get(names[taxon[v]])
+            blocks[v] = [] if p is None else [p]
+            continue
+        below = [blocks[child[lo + i]] for i in range(0, k)]
+        cost = [[0] * k for i in range(0, k)]
+        for i in range(0, k):
+            for j in range(i + 1, k):
+                cost[i][j] = block_crossings(below[i], below[j])
+                cost[j][i] = len(below[i]) * len(below[j]) - cost[i][j]
+        best = None
+        for t in [twist[v]] + range(0, k):
+            order = [(j - t) % k for j in range(0, k)]
+            c = sum(cost[order[a]][order[b]] for a in range(0, k) for b in range(a + 1, k))
+            if best is None or c < best:
+                (best, twists[v]) = (c, t)
+        blocks[v] = sorted(itertools.chain(*below))
+        for i in range(0, k):
+            blocks[child[lo + i]] = None
+    return [twists[v] for v in tr.internal]
+
+def one_sided(tree_list, reference=None):
+    """ Rotate every tree of tree_list but the reference (by default the first) to cross
+    the current leaf order of the reference as little as possible. Returns the total number
+    of crossings left between the reference and the other trees """
+    if len(tree_list) == 0:
+        return 0
+    if reference is None:
+        reference = tree_list[0]
+    order = list(reference.leaves())
+    for tr in tree_list:
+        if not tr is reference:
+            tr.apply_twists(one_sided_twists(tr, order))
+    return sum(crossing_count(order, list(tr.leaves())) for tr in tree_list if not tr is reference)
+
+def shared_compact(tree_list, taxa):
+    """ compact_tree copies of the trees, with their twists, all using the taxon table taxa """
+    copies = []
+    for tr in tree_list:
+        ct = compact_tree(taxa=taxa)
+        if isinstance(tr, compact_tree):
+            ct.init_from_lists(tr.name, list(tr.parent),
+                [tr.taxa.names[x] if x >= 0 else None for x in tr.taxon])
+            ct.apply_twists(tr.get_twists())
+        else:
+            ct.init_from_tree(tr)
+        copies.append(ct)
+    return copies
+
+def before(i, j, t, k):
+    """ Whether child i comes before child j of a node with k children and twist t """
+    return (i + t) % k < (j + t) % k
+
+class crossing_problem:
+    """ crossing_problem: the number of crossing lines between every pair of trees, as a
+         function of the twists of their nodes, for the exact solver. Two taxa cross between
+         two trees exactly when the twists of their lowest common ancestors in the two trees
+         put them in different orders, so the total is a sum, over pairs (w, u) of nodes of
+         different trees, of a table cost[t][s] of the twists t of w and s of u.
+
+         Nodes with at least two children are numbered globally; tree[g] and node[g] give
+         the tree index and node id of g, size[g] its number of children, and adjacent[g]
+         the list of (h, cost) of the nodes h sharing a table with g, cost indexed by the
+         twist of g first. Pairs of trees are weighted by pair_weights, as in the scorer.
+    """
+    def __init__(self, tree_list, pair_weights=None):
+        if pair_weights is None:
+            pair_weights = g_pair_weights
+        self.taxa = taxon_table()
+        self.trees = shared_compact(tree_list, self.taxa)
+        self.tree = []
+        self.node = []
+        self.size = []
+        index = {}
+        lca = []
+        for a in range(0, len(self.trees)):
+            tr = self.trees[a]
+            offset = tr.offset
+            child = tr.child
+            """ the lowest common ancestor of every pair of taxa x < y, with the children of it
+            holding x and y """
+            pairs = {}
+            below = [None] * len(tr.parent)
+            for v in range(len(tr.parent) - 1, -1, -1):
+                lo = offset[v]
+                k = offset[v + 1] - lo
+                if k == 0:
+                    below[v] = [tr.taxon[v]]
+                    continue
+                blocks = [below[child[lo + i]] for i in range(0, k)]
+                if k > 1:
+                    index[(a, v)] = len(self.node)
+                    self.tree.append(a)
+                    self.node.append(v)
+                    self.size.append(k)
+                    g = index[(a, v)]
+                    for i in range(0, k):
+                        for j in range(i + 1, k):
+                            for x in blocks[i]:
+                                for y in blocks[j]:
+                                    if x < y:
+                                        pairs[(x, y)] = (g, i, j)
+                                    else:
+                                        pairs[(y, x)] = (g, j, i)
+                below[v] = list(itertools.chain(*blocks))
+                for i in range(0, k):
+                    below[child[lo + i]] = None
+            lca.append(pairs)
+        self.adjacent = [[] for g in self.node]
+        self.edges = 0
+        for (a, b) in itertools.combinations(range(0, len(self.trees)), 2):
+            w = pair_weight(pair_weights, self.trees[a].name, self.trees[b].name)
+            if w == 0:
+                continue
+            counts = {}
+            other = lca[b]
+            for (key, (g, i, j)) in lca[a].iteritems():
+                found = other.get(key)
+                if not found is None:
+                    (h, i2, j2) = found
+                    c = counts.setdefault((g, h), {})
+                    c[(i, j, i2, j2)] = c.get((i, j, i2, j2), 0) + 1
+            for ((g, h), c) in counts.iteritems():
+                cost = [[0] * self.size[h] for t in range(0, self.size[g])]
+                for t in range(0, self.size[g]):
+                    for s in range(0, self.size[h]):
+                        for ((i, j, i2, j2), n) in c.iteritems():
+                            if before(i, j, t, self.size[g]) != before(i2, j2, s, self.size[h]):
+                                cost[t][s] += w * n
+                self.adjacent[g].append((h, cost))
+                self.adjacent[h].append((g, [list(x) for x in zip(*cost)]))
+                self.edges += 1
+
+    def twist(self, g):
+        """ The current twist of node g """
+        return self.trees[self.tree[g]].twist[self.node[g]]
+
+    def value(self, twist):
+        """ The total of the tables for a twist of every node (a list indexed like node) """
+        total = 0
+        for g in range(0, len(self.node)):
+            for (h, cost) in self.adjacent[g]:
+                if g < h:
+                    total += cost[twist[g]][twist[h]]
+        return total
+
+    def lower_bound(self):
+        """ A lower bound of the crossings of any layout: the smallest entry of every table """
+        return sum(min(min(x) for x in cost) for g in range(0, len(self.node))
+            for (h, cost) in self.adjacent[g] if g < h)
+
+    def solve(self, time_limit=None):
+        """ Branch and bound over the twists of the nodes of every tree but the last, largest
+        nodes first. With the other trees fixed, the best twist of every node of the last
+        tree is found independently, so the bound is exact once they are all decided. The
+        bound adds, to the tables between decided nodes, the best twist of every undecided
+        node given its decided neighbours, and the smallest entry of every table between two
+        undecided nodes. Returns (best, lower bound, twists) - best equals the lower bound
+        unless the time limit cut the search short - with twists indexed like node """
+        if time_limit is None:
+            time_limit = g_exact_time_limit
+        started = time.time()
+        n = len(self.node)
+        last = len(self.trees) - 1
+        """ f[g][t]: the tables between g, at twist t, and its decided neighbours """
+        f = [[0] * self.size[g] for g in range(0, n)]
+        twist = [None] * n
+        smallest = dict(((g, h), min(min(x) for x in cost)) for g in range(0, n)
+            for (h, cost) in self.adjacent[g])
+        state = {'decided': 0, 'open': sum(smallest[(g, h)] for (g, h) in smallest if g < h),
+            'free': 0}
+
+        def decide(g, t):
+            state['decided'] += f[g][t]
+            state['free'] -= min(f[g])
+            for (h, cost) in self.adjacent[g]:
+                if twist[h] is None:
+                    fh = f[h]
+                    state['free'] -= min(fh)
+                    row = cost[t]
+                    for s in range(0, len(fh)):
+                        fh[s] += row[s]
+                    state['free'] += min(fh)
+                    state['open'] -= smallest[(g, h)]
+            twist[g] = t
+
+        def undecide(g):
+            t = twist[g]
+            twist[g] = None
+            for (h, cost) in self.adjacent[g]:
+                if twist[h] is None:
+                    fh = f[h]
+                    state['free'] -= min(fh)
+                    row = cost[t]
+                    for s in range(0, len(fh)):
+                        fh[s] -= row[s]
+                    state['free'] += min(fh)
+                    state['open'] += smallest[(g, h)]
+            state['free'] += min(f[g])
+            state['decided'] -= f[g][t]
+
+        def bound():
+            return state['decided'] + state['free'] + state['open']
+
+        def completed():
+            """ The twists of a leaf of the search, with the best twists for the last tree """
+            return [twist[g] if not twist[g] is None else f[g].index(min(f[g])) for g in range(0, n)]
+
+        order = sorted([g for g in range(0, n) if self.tree[g] != last],
+            key=lambda g: -self.trees[self.tree[g]].size[self.node[g]])
+        """ With only binary nodes, turning every node of every tree gives the mirror image,
+        with as many crossings, so the first node can be left as it is """
+        fixed = []
+        if len(order) > 0 and max(self.size) == 2:
+            fixed = [order.pop(0)]
+            decide(fixed[0], self.twist(fixed[0]))
+        """ The current layout is the first solution """
+        for g in order:
+            decide(g, self.twist(g))
+        best = bound()
+        best_twist = completed()
+        for g in reversed(order):
+            undecide(g)
+        lower = None
+        stack = []
+        if len(order) == 0:
+            lower = best
+        else:
+            g = order[0]
+            stack.append([g, sorted((bound() - min(f[g]) + f[g][t], t)
+                for t in range(0, self.size[g])), 0])
+        count = 0
+        while len(stack) > 0:
+            level = stack[-1]
+            (g, candidates, k) = level
+            if not twist[g] is None:
+                undecide(g)
+            if k == len(candidates) or candidates[k][0] >= best:
+                stack.pop()
+                continue
+            count += 1
+            if count % 256 == 0 and time.time() - started > time_limit:
+                lower = min([best] + [l[1][l[2]][0] for l in stack if l[2] < len(l[1])])
+                break
+            level[2] += 1
+            decide(g, candidates[k][1])
+            b = bound()
+            if b >= best:
+                continue
+            if len(stack) == len(order):
+                best = b
+                best_twist = completed()
+                continue
+            h = order[len(stack)]
+            stack.append([h, sorted((b - min(f[h]) + f[h][t], t)
+                for t in range(0, self.size[h])), 0])
+        if lower is None:
+            lower = best
+        return (best, lower, best_twist)
+
+    def apply(self, tree_list, twist):
+        """ Give the trees (those the problem was made from) the twists of a solution """
+        for a in range(0, len(self.trees)):
+            ct = self.trees[a]
+            t = ct.get_twists()
+            position = dict((ct.internal[i], i) for i in range(0, len(ct.internal)))
+            for g in range(0, len(self.node)):
+                if self.tree[g] == a:
+                    t[position[self.node[g]]] = twist[g]
+            ct.apply_twists(t)
+            tree_list[a].apply_twists(t)
+
+def exact(tree_list, time_limit=None, pair_weights=None):
+    """ Find the layout of the trees with the fewest crossing lines (weighted by pair_weights)
+    by branch and bound, meant for two or three trees of moderate size. The trees are left in
+    the best layout found. Returns (crossings, lower bound): when the time limit stops the
+    search early, the optimum lies between the two """
+    problem = crossing_problem(tree_list, pair_weights)
+    (best, lower, twist) = problem.solve(time_limit)
+    problem.apply(tree_list, twist)
+    return (best, lower)
+
+def crossing_lower_bound(tree_list, pair_weights=None, time_limit=0):
+    """ A lower bound of the (pair weighted) crossings of any layout of the trees, to use as
+    the crossing_target of process_trees. With a time limit, the bound is tightened by that
+    long a branch and bound """
+    problem = crossing_problem(tree_list, pair_weights)
+    if time_limit > 0:
+        return problem.solve(time_limit)[1]
+    return problem.lower_bound()
+
 tree_list = []
-g_starting_intensity = 50
-g_number_of_iterations_before_reducing_intensity = 50
-g_max_count = 5000
-g_max_iterations_without_improvement = 5000
-g_intensity_reduction = 0.99
-g_skip_first_tree = 0
 
 def process_trees(tree_list, starting_intensity=g_starting_intensity,
     number_of_iterations_before_reducing_intensity=g_number_of_iterations_before_reducing_intensity,
@@ -297,75 +2300,445 @@ def process_trees(tree_list, starting_intensity=g_starting_intensity,
     max_iterations_without_improvement = g_max_iterations_without_improvement,
     intensity_reduction = g_intensity_reduction,
     skip_first_tree = g_skip_first_tree,
-    output_filename = g_output_filename):
+    output_filename = g_output_filename,
+    objective = g_objective,
+    verbose = True,
+    checkpoint_interval = g_checkpoint_interval,
+    checkpoint_filename = None,
+    resume = None,
+    target = None,
+    crossing_target = None,
+    observer = None,
+    weights = None,
+    pair_weights = None,
+    one_sided_start = g_one_sided_start,
+    anchor = g_anchor,
+    sample_pairs = g_sample_pairs,
+    refresh_interval = g_refresh_interval,
+    schedule = g_schedule,
+    target_acceptance = g_target_acceptance,
+    stop_window = g_stop_window,
+    stop_epsilon = g_stop_epsilon,
+    time_limit = g_time_limit,
+    candidates = g_candidates):
     """Calculate an initial minimization function value,
     then iteratively take each tree in turn,
     apply _intensity_ random twists to it, and compare the
     overall result with *all* trees for the minimization function.
     Slowly reduce the intensity over time as continued operation
     at a given intensity level ceases to produce improvement.
+    Nothing is written if output_filename is None.
+    weights and pair_weights set the weight of each component of the objective and of each
+    pair of trees, as in scorer.
+    With one_sided_start (and no resume), the trees are first laid out by one_sided against
+    the first tree, which leaves far less for the random search to do.
+    For large numbers of trees, anchor scores every tree against one tree (by name) or
+    against their 'consensus' order only, and sample_pairs scores each move on that many
+    of the pairs involving the twisted tree, re-scoring all pairs every refresh_interval
+    iterations; see g_anchor and g_sample_pairs.
+    If target is given, stop as soon as the best value is no more than target, and with
+    crossing_target, as soon as the (pair weighted) crossings of the best layout are no more
+    than crossing_target, e.g. crossing_lower_bound; 'crossing' must then be weighted in
+    the objective, and every pair scored (no anchor).
+    With schedule 'adaptive', the intensity follows the acceptance rate of the moves instead
+    (see acceptance_schedule), aiming at target_acceptance; the reduction parameters are then
+    unused. With stop_window, stop once the best value has improved by no more than
+    stop_epsilon over that many iterations. With time_limit, stop after that many seconds
+    (counted from the call), keeping the best layout found so far.
+    With candidates > 1, every move draws that many twist lists for the tree, scores them
+    all at once with scorer.score_candidates and tries the best of them; tried then counts
+    every candidate.
+    Returns the best value found.
+
+    Progress is reported by calling observer (a progress_reporter if verbose and no observer
+    is given) at the start of every iteration, and once more with 'finished' set at the end,
+    with a dict of: iteration, intensity, best, objective, accepted and tried (moves scored so
+    far), skipped (moves that left the layout as it was, which are not scored), evaluations,
+    cache_hits, elapsed, evaluations_per_second, components (the total of every component
+    of the best layout) and timings (the seconds spent on every component). With no observer
+    nothing is printed and nothing beyond the optimization itself is evaluated.
+
+    Improvements are checkpointed to output_filename and checkpoint_filename (by default
+    output_filename + '.ckpt') by a checkpointer, at most every checkpoint_interval seconds
+    and on the way out. The state is taken at the start of an iteration: the twists of
+    every tree, the best value, intensity, counters and random generator state. Passing
+    such a state as resume continues from it exactly as the original run would have.
     """
+    started = time.time()
+    deadline = None if time_limit is None else started + time_limit
+    if one_sided_start and resume is None:
+        one_sided(tree_list)
     first_tree = None
     trees = {}
     twists = {}
+    sizes = {}
     for tr in tree_list:
         if first_tree == None:
             first_tree = tr.name
-        tr.print_tree()
         trees[tr.name] = tr
         twists[tr.name] = tr.get_twists()
+        sizes[tr.name] = tr.twist_sizes()
     
-    print tangle_count_all(trees)
-    write(output_filename,tree_list)
-
-    best = minimize_this(trees)
     count = 1
     intensity = starting_intensity
     last_success = 0
-    flip = 1
-    while intensity > 0 and count < max_count:
-        print "Iteration " + str(count) + ", Intensity " + str(intensity) + ", Optimize " + str(best) + ", Tangle Count " + str(tangle_count_all(trees))
-        for i in range(0,len(trees)):
-            if skip_first_tree == 0 or trees[trees.keys()[i]].name <> first_tree:
-                t = list(twists[twists.keys()[i]])
-                t2 = list(t)
-                for j in range(0,intensity):
-                    t[random.randint(0,len(t)-1)] += 1
-                trees[trees.keys()[i]].apply_twists(t)
-                cur = minimize_this(trees)
-                if cur < best:
-                    """ If we succeeded in finding a better result, preserve it """
-                    last_success = 0
-                    twists[twists.keys()[i]] = t
-                    best = cur
-                    write("result" + str(flip) + ".dat",tree_list)
-                    flip = 3 - flip 
-                else:
-                    """ Our new result is no better, keep the old tree """
-                    trees[trees.keys()[i]].apply_twists(t2)
-                    last_success += 1
-                if last_success > number_of_iterations_before_reducing_intensity and intensity > 1:
-                    intensity = int(intensity * intensity_reduction)
-                    last_success = 0
-                if last_success > max_iterations_without_improvement and intensity == 1:
-                    intensity = 0
-        count += 1
-    write(output_filename,tree_list)
+    adaptive = None
+    if schedule == 'adaptive':
+        adaptive = acceptance_schedule(starting_intensity, target_acceptance)
+        intensity = adaptive.intensity()
+    elif schedule != 'fixed':
+        raise ValueError("unknown schedule: " + str(schedule))
+    """ history holds the best value at the start of each of the last stop_window iterations """
+    history = deque()
+    if not resume is None:
+        if sorted(resume['twists'].keys()) != sorted(trees.keys()):
+            raise ValueError("checkpoint does not match the trees being optimized")
+        for (name, t) in resume['twists'].iteritems():
+            trees[name].apply_twists(t)
+            twists[name] = trees[name].get_twists()
+        count = resume['count']
+        intensity = resume['intensity']
+        last_success = resume['last_success']
+        random.setstate(resume['random'])
+        if not adaptive is None and 'schedule' in resume:
+            adaptive.set_state(resume['schedule'])
+        history.extend(resume.get('history', []))
+
+    if observer is None and verbose:
+        observer = progress_reporter()
+    ck = None
+    if not output_filename is None:
+        write(output_filename,tree_list)
+        ck = checkpointer(tree_list, output_filename, checkpoint_filename, checkpoint_interval)
+
+    scored = trees
+    anchor_order = None
+    if anchor == 'consensus':
+        anchor = '<consensus>'
+        """ A resumed run keeps the consensus of the original run, not that of its own start """
+        if not resume is None and 'anchor_order' in resume:
+            anchor_order = resume['anchor_order']
+        else:
+            anchor_order = consensus_order(tree_list)
+        scored = dict(trees)
+        scored[anchor] = fixed_order(anchor, anchor_order,
+            getattr(tree_list[0], 'taxa', None) if len(tree_list) > 0 else None)
+    elif not anchor is None and not anchor in trees:
+        raise ValueError("no tree named " + str(anchor) + " to anchor to")
+    sc = scorer(scored, objective, weights=weights, pair_weights=pair_weights, anchor=anchor,
+        sample=sample_pairs)
+    if not crossing_target is None and (not 'crossing' in sc.totals or not anchor is None):
+        raise ValueError("crossing_target needs 'crossing' in the objective and every pair scored")
+    best = sc.total()
+    if not resume is None and not sample_pairs is None and 'stale' in resume:
+        """ Carry on from the values extrapolated from sampled pairs, not the exact ones """
+        sc.set_stale(resume['stale'])
+        best = resume['best']
+    improved = False
+    state = None
+    finished = False
+    accepted = 0
+    tried = 0
+    skipped = 0
+    out_of_time = False
+    def get_state():
+        state = {'twists': dict(twists), 'best': best, 'intensity': intensity,
+            'count': count, 'last_success': last_success, 'random': random.getstate(),
+            'history': list(history)}
+        if not adaptive is None:
+            state['schedule'] = adaptive.get_state()
+        if not sample_pairs is None:
+            state['stale'] = sc.get_stale()
+        if not anchor_order is None:
+            state['anchor_order'] = list(anchor_order)
+        return state
+    def report(finished):
+        elapsed = time.time() - started
+        observer({'iteration': count, 'intensity': intensity, 'best': best, 'objective': objective,
+            'accepted': accepted, 'tried': tried, 'skipped': skipped, 'evaluations': sc.evaluations,
+            'cache_hits': sc.hits, 'elapsed': elapsed,
+            'evaluations_per_second': sc.evaluations / elapsed if elapsed > 0 else 0.0,
+            'components': dict(sc.totals), 'timings': dict(sc.timings), 'finished': finished})
+    try:
+        while intensity > 0 and count < max_count and (target is None or best > target) \
+            and (crossing_target is None or sc.totals['crossing'] > crossing_target) \
+            and not out_of_time:
+            if not sample_pairs is None and count % refresh_interval == 0:
+                """ Correct the drift of the values extrapolated from sampled pairs """
+                best = sc.refresh()
+            if not ck is None:
+                state = get_state()
+                if improved and ck.due():
+                    improved = False
+                    ck.submit(state)
+            if not stop_window is None:
+                history.append(best)
+                if len(history) > stop_window:
+                    history.popleft()
+                    if history[0] - best <= stop_epsilon:
+                        break
+            if not observer is None:
+                report(False)
+            for i in range(0,len(trees)):
+                if not deadline is None and time.time() >= deadline:
+                    out_of_time = True
+                    break
+                if skip_first_tree == 0 or trees[trees.keys()[i]].name <> first_tree:
+                    t = list(twists[twists.keys()[i]])
+                    t2 = list(t)
+                    size = sizes[twists.keys()[i]]
+                    estimate = None
+                    if candidates > 1:
+                        """ Draw several moves, score them together, and try the best """
+                        batch = []
+                        for m in range(0, candidates):
+                            c = list(t2)
+                            for j in range(0,intensity):
+                                k = random.randint(0,len(c)-1)
+                                c[k] = (c[k] + 1) % size[k]
+                            if c != t2 and not c in batch:
+                                batch.append(c)
+                        if len(batch) > 0:
+                            scores = sc.score_candidates(trees.keys()[i], batch)
+                            estimate = min(scores)
+                            t = batch[scores.index(estimate)]
+                            tried += len(batch) - 1
+                    else:
+                        for j in range(0,intensity):
+                            k = random.randint(0,len(t)-1)
+                            t[k] = (t[k] + 1) % size[k]
+                    if t == t2:
+                        """ The twists cancel out, the layout is unchanged and cannot be better """
+                        skipped += 1
+                        last_success += 1
+                    elif not estimate is None and estimate >= best:
+                        """ No candidate is better, so the best one need not be applied """
+                        tried += 1
+                        last_success += 1
+                        if not adaptive is None:
+                            intensity = adaptive.record(False)
+                    else:
+                        span = trees[trees.keys()[i]].apply_twists(t)
+                        cur = sc.update(trees.keys()[i], span)
+                        tried += 1
+                        if cur < best:
+                            """ If we succeeded in finding a better result, preserve it """
+                            sc.accept()
+                            accepted += 1
+                            last_success = 0
+                            twists[twists.keys()[i]] = t
+                            best = cur
+                            improved = not ck is None
+                        else:
+                            """ Our new result is no better, keep the old tree """
+                            trees[trees.keys()[i]].apply_twists(t2)
+                            sc.reject()
+                            last_success += 1
+                        if not adaptive is None:
+                            intensity = adaptive.record(last_success == 0)
+                    if adaptive is None and last_success > number_of_iterations_before_reducing_intensity \
+                        and intensity > 1:
+                        intensity = int(intensity * intensity_reduction)
+                        last_success = 0
+                    if last_success > max_iterations_without_improvement and intensity == 1:
+                        intensity = 0
+            count += 1
+        if not sample_pairs is None:
+            best = sc.refresh()
+        finished = True
+        if not observer is None:
+            report(True)
+    finally:
+        if not ck is None:
+            """ Keep whatever has been found. If we were interrupted, checkpoint the start of
+            the interrupted iteration, so that a resumed run replays it exactly """
+            for name in trees.keys():
+                trees[name].apply_twists(twists[name])
+            if finished or state is None:
+                state = get_state()
+            ck.submit(state)
+            ck.close()
+    return best
+
+def weight_argument(text):
+    """ argparse type for --weight NAME=WEIGHT """
+    (name, sep, value) = text.rpartition('=')
+    try:
+        return (name, float(value))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected NAME=WEIGHT, not " + repr(text))
+
+def pair_weight_argument(text):
+    """ argparse type for --pair-weight TREE:TREE=WEIGHT """
+    (pair, weight) = weight_argument(text)
+    (a, sep, b) = pair.partition(':')
+    if sep == '':
+        raise argparse.ArgumentTypeError("expected TREE:TREE=WEIGHT, not " + repr(text))
+    return ((a, b), weight)
+
+def add_objective_arguments(parser):
+    """ Add the options choosing what is minimized to an argparse parser """
+    parser.add_argument('--objective', choices=['tangle', 'crossing'], default=g_objective,
+        help='tangling measure: adjacent flips (fast) or crossing lines')
+    parser.add_argument('--weight', type=weight_argument, action='append', default=[],
+        metavar='NAME=WEIGHT', help='weight of a component: ' + ', '.join(sorted(g_components)) +
+        ' (repeatable, 0 disables)')
+    parser.add_argument('--pair-weight', type=pair_weight_argument, action='append', default=[],
+        metavar='TREE:TREE=WEIGHT', help="weight of a pair of trees, '*' matches any tree " +
+        "(repeatable, 0 skips the pair)")
+
+def objective_options(args):
+    """ The process_trees options set by add_objective_arguments """
+    weights = dict(args.weight)
+    for c in weights:
+        if not c in g_components:
+            raise SystemExit("unknown objective component: " + c)
+    return {'objective': args.objective, 'weights': weights, 'pair_weights': dict(args.pair_weight)}
+
+def add_search_arguments(parser):
+    """ Add the options steering the random search of process_trees to an argparse parser """
+    parser.add_argument('--one-sided-start', action='store_true', default=bool(g_one_sided_start),
+        help='start the random search from the --one-sided layout')
+    parser.add_argument('--anchor', default=g_anchor, metavar='TREE',
+        help="score every tree against this tree (or 'consensus', the mean order) only")
+    parser.add_argument('--sample-pairs', type=int, default=g_sample_pairs, metavar='M',
+        help='score each move on M random pairs, re-scoring all of them every --refresh-interval iterations')
+    parser.add_argument('--refresh-interval', type=int, default=g_refresh_interval)
+    parser.add_argument('--schedule', choices=['fixed', 'adaptive'], default=g_schedule,
+        help='reduce the intensity at a fixed rate, or set it from the acceptance rate')
+    parser.add_argument('--target-acceptance', type=float, default=g_target_acceptance,
+        help='acceptance rate the adaptive schedule aims at')
+    parser.add_argument('--stop-window', type=int, default=g_stop_window, metavar='N',
+        help='stop when the best value has improved by no more than --stop-epsilon in N iterations')
+    parser.add_argument('--stop-epsilon', type=float, default=g_stop_epsilon)
+    parser.add_argument('--time-limit', type=float, default=g_time_limit, metavar='SECONDS',
+        help='stop after SECONDS (of every run), keeping the best layout found')
+    parser.add_argument('--candidates', type=int, default=g_candidates, metavar='M',
+        help='draw M moves for each tree at every step, score them together and try the best')
+
+def search_options(args):
+    """ The process_trees options set by add_search_arguments """
+    return {'one_sided_start': args.one_sided_start, 'anchor': args.anchor,
+        'sample_pairs': args.sample_pairs, 'refresh_interval': args.refresh_interval,
+        'schedule': args.schedule, 'target_acceptance': args.target_acceptance,
+        'stop_window': args.stop_window, 'stop_epsilon': args.stop_epsilon,
+        'time_limit': args.time_limit, 'candidates': args.candidates}
+
+def restart_chain(job):
+    """ Run one independent process_trees chain for process_restarts, from the given twists
+    and seed, and return the seed, the best value and the resulting twists of every tree """
+    (tree_list, twists, seed, options) = job
+    for (tr, t) in zip(tree_list, twists):
+        tr.apply_twists(t)
+    random.seed(seed)
+    best = process_trees(tree_list, output_filename=None, verbose=False, **options)
+    return (seed, best, [tr.get_twists() for tr in tree_list])
+
+def process_restarts(tree_list, restarts, jobs=1, seed=None,
+    output_filename = g_output_filename, **options):
+    """Run _restarts_ independent process_trees chains, seeded seed, seed+1, ...,
+    on a pool of _jobs_ processes. The trees are left with the twists of the best
+    scoring chain, which are written to output_filename, and the seed and score of
+    every chain are written to output_filename + '.seeds'.
+    Returns (seed, best value, twists) of the best chain.
+    """
+    if seed is None:
+        seed = random.randint(0, 2**31 - 1)
+    twists = [tr.get_twists() for tr in tree_list]
+    work = [(tree_list, twists, seed + i, options) for i in range(0, restarts)]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        """ get() with a timeout keeps the pool responsive to ctrl-c """
+        results = pool.map_async(restart_chain, work, 1).get(2**31)
+        pool.close()
+        pool.join()
+    else:
+        results = map(restart_chain, work)
+    winner = min(results, key=lambda r: r[1])
+    for (tr, t) in zip(tree_list, winner[2]):
+        tr.apply_twists(t)
+    if not output_filename is None:
+        write(output_filename, tree_list)
+        with open(output_filename + '.seeds', 'w') as f:
+            f.write("seed\tscore\n")
+            for (s, best, t) in results:
+                f.write(str(s) + "\t" + str(best) + "\n")
+    return winner
 
 if __name__=='__main__':
     """
     Loop over all files, reading in all available trees.
     Print the results (for testing/validation purposes).
     """
-    for line in fileinput.input():
-        #line = line.trim()
-        if line[0:4] == 'tree':
-            tr = tree(line)
-            print tr
+    parser = argparse.ArgumentParser(description = 'Minimize tangling across multiple trees.')
+    parser.add_argument('-o', '--output-filename', dest='output_filename', default=g_output_filename)
+    parser.add_argument('--restarts', type=int, default=1,
+        help='number of independent runs to make, keeping the best')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='number of processes to spread the restarts over')
+    parser.add_argument('--seed', type=int, default=None,
+        help='random seed (of the first restart)')
+    parser.add_argument('--checkpoint-interval', type=float, default=g_checkpoint_interval,
+        help='minimum number of seconds between checkpoints')
+    parser.add_argument('--resume', default=None, metavar='CHECKPOINT',
+        help='continue the run saved in a .ckpt file')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help='print no progress')
+    parser.add_argument('--report-interval', type=float, default=g_report_interval,
+        help='minimum number of seconds between progress lines')
+    parser.add_argument('--one-sided', action='store_true',
+        help='only rotate every tree to cross the first tree as little as possible, exactly and fast')
+    parser.add_argument('--exact', action='store_true',
+        help='find the fewest crossings by branch and bound (for 2 or 3 trees)')
+    parser.add_argument('--exact-time-limit', type=float, default=g_exact_time_limit, metavar='SECONDS',
+        help='search for at most SECONDS with --exact')
+    parser.add_argument('--stop-at-bound', action='store_true',
+        help='stop the random search if it reaches the crossing lower bound')
+    parser.add_argument('--bound-time-limit', type=float, default=0, metavar='SECONDS',
+        help='tighten the bound of --stop-at-bound by SECONDS of branch and bound')
+    add_objective_arguments(parser)
+    add_search_arguments(parser)
+    parser.add_argument('infiles', nargs='+')
+    args = parser.parse_args()
+    options = objective_options(args)
+    options.update(search_options(args))
+    for filename in args.infiles:
+        for tr in read_trees(filename):
             tree_list.append(tr)
-            #trees[tr.name] = tr
-            #twists[tr.name] = tr.get_twists()
-            #print trees
-    process_trees(tree_list)
+    if args.stop_at_bound:
+        if objective_weights(args.objective, options['weights']).get('crossing', 0) == 0:
+            parser.error("--stop-at-bound needs crossing in the objective (--objective crossing " +
+                "or --weight crossing=W)")
+        if not options['anchor'] is None:
+            parser.error("--stop-at-bound cannot be combined with --anchor")
+        options['crossing_target'] = crossing_lower_bound(tree_list, options['pair_weights'],
+            args.bound_time_limit)
+    if args.exact:
+        (best, lower) = exact(tree_list, args.exact_time_limit, options['pair_weights'])
+        write(args.output_filename, tree_list)
+        print "Crossings " + str(best) + ", Lower Bound " + str(lower) + ", Gap " + str(best - lower) + \
+            (" (optimal)" if best == lower else " (time limit reached)")
+    elif args.one_sided:
+        crossings = one_sided(tree_list)
+        write(args.output_filename, tree_list)
+        print "Crossings with the first tree " + str(crossings) + ", Optimize " + \
+            str(minimize_this(dict((tr.name, tr) for tr in tree_list), args.objective,
+            options['weights'], options['pair_weights']))
+    elif args.restarts > 1:
+        (seed, best, t) = process_restarts(tree_list, args.restarts, args.jobs, args.seed,
+            output_filename = args.output_filename, **options)
+        print "Best of " + str(args.restarts) + " runs: seed " + str(seed) + ", Optimize " + str(best)
+    else:
+        if not args.seed is None:
+            random.seed(args.seed)
+        """ Let a terminated job (e.g. a preempted node) checkpoint on the way out like ctrl-c """
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        resume = None
+        if not args.resume is None:
+            resume = load_checkpoint(args.resume)
+        observer = None if args.quiet else progress_reporter(args.report_interval)
+        process_trees(tree_list, output_filename = args.output_filename,
+            checkpoint_interval = args.checkpoint_interval, resume = resume,
+            verbose = not args.quiet, observer = observer, **options)
                     
                 
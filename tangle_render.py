@@ -8,22 +8,40 @@ tangle_render.py [filename] ...
 
 Pass any number of filenames, detangle will extract all trees, and render tangles on all
 combinations of trees.
+
+Every tree is laid out once (its leaf order, the width of its labels and its branches as line
+segments, see tree_layout), and every drawing reuses those layouts. The per-pair files are
+rendered on a pool of --jobs processes.
+
+Drawings are made with cairo when it is installed, or else (or with --backend svg) by
+svg_writer, which needs nothing beyond Python: it streams the SVG to the file as it is drawn,
+writes all the connecting lines of a pair as one path element and all the branches of a tree as
+another, and estimates the width of the labels instead of measuring them.
 """
 
 line_gap = 5
 line_region_width = 260
 line_darkness = 0.3
+font_face = "Georgia"
+font_size = 12
 
-from detangle import tree, node
-from sys import argv
-import fileinput
+from detangle import tree, node, read_trees
 from collections import deque
 import itertools
 import random
 import time
+import argparse
+import multiprocessing
+from xml.sax.saxutils import escape, quoteattr
 
-import cairo
-import rsvg
+try:
+    import cairo
+except ImportError:
+    cairo = None
+try:
+    import rsvg
+except ImportError:
+    rsvg = None
 
 def tangle_count_all():
     """ This function applies a tangle counting function to every combination of trees
@@ -71,91 +89,311 @@ trees = {}
 twists = {}
 first_tree = None
 
-def draw_tree(ct, tr, x_pos, height):
-    ct.set_source_rgb(0, 0, 0)
-    widest = 0
-    x, y, w, h = ct.text_extents("Tree: " + tr.name)[:4]
-    widest = w
-    ct.move_to(x_pos, 0)
-    ct.show_text("Tree: " + tr.name)
-    vert = height
-    for l in tr.leaves():
-        x, y, w, h = ct.text_extents(l)[:4]
-        widest = max(w, widest)
-        ct.move_to(x_pos, vert)
-        ct.show_text(l)
-        vert += height
-    return widest
+branch_length = 20
 
-def draw_lines(ct, left, right, x1, x2, height):
-    ct.set_source_rgba(0, 0, 0, line_darkness)
-    b = right.leaves()
-    t = dict((b[i],i) for i in range(0,len(b)))
-    i = 1
-    for l in left.leaves():
-        if t.has_key(l):
-            ct.move_to(x1, height * i - (height / 3))
-            ct.line_to(x2, height * (t[l] + 1) - (height / 3))
-            ct.stroke()
-        i += 1
+class text_metrics:
+    """ text_metrics: the width of a label, as measured by a drawing context, remembered so
+         that every distinct label is only measured once """
+    def __init__(self, ct):
+        self.ct = ct
+        self.widths = {}
 
-def draw_branches(ct, tr, x_pos, y_pos, height, branch_length, facing_right = True, depth = 0, current = None, max_depth = 0):   
-    if current == None:
-        current = tr.root
+    def __call__(self, text):
+        w = self.widths.get(text)
+        if w is None:
+            w = self.ct.text_extents(text)[2]
+            self.widths[text] = w
+        return w
+
+class tree_layout:
+    """ tree_layout: everything needed to draw a tree, computed once per tree and shared by
+         every drawing it appears in: the leaf order and the position of every leaf, the width
+         of the widest label, and the branches facing either way as line segments. It holds no
+         cairo objects, so it can be handed to other processes.
+    """
+    def __init__(self, tr, text_width, height, branch_length=branch_length):
+        self.name = tr.name
+        self.title = "Tree: " + tr.name
+        self.leaves = tr.leaves()
+        self.index = dict((self.leaves[i], i) for i in range(0, len(self.leaves)))
+        self.widest = max([text_width(self.title)] + [text_width(l) for l in self.leaves])
+        self.height = height
+        self.max_depth = tr.max_depth()
+        self.branch_width = (self.max_depth + 1) * branch_length
+        self.branches = {True: branch_segments(tr, height, branch_length, True, self.max_depth),
+            False: branch_segments(tr, height, branch_length, False, self.max_depth)}
+
+def branch_segments(tr, height, branch_length, facing_right = True, max_depth = None):
+    """ The branches of tr, as (x1, y1, x2, y2) segments relative to its top left corner,
+    with the leaves height apart and each level branch_length wide """
+    if max_depth is None:
         max_depth = tr.max_depth()
-    top = 0.00
-    upper = None
-    lower = 0.00
-    total_height = 0
-    middle_height = 0
-    #print y_pos
-    children = current.get_children()
-    for i in children:
-        if (i.has_children()):
-            (total_height, middle_height) = draw_branches(ct, tr, x_pos, y_pos + top, height, branch_length, facing_right, depth + 1, i, max_depth)
-            if facing_right:
-                ct.move_to(x_pos + (branch_length * depth), y_pos + top + middle_height)
-                ct.line_to(x_pos + (branch_length * (depth + 1)), y_pos + top + middle_height)
-            else:
-                ct.move_to(x_pos + (branch_length * (max_depth-depth)), y_pos + top + middle_height)
-                ct.line_to(x_pos + (branch_length * ((max_depth-depth) - 1)), y_pos + top + middle_height)
-            ct.stroke()
+    segments = []
+    def x(depth):
+        if facing_right:
+            return branch_length * depth
+        return branch_length * (max_depth - depth)
+    """ Each frame of the stack is a node whose children are being laid out:
+    [node, y_pos, depth, children, next child, top, upper, lower], as the locals of a
+    recursive walk would be; result is what the last finished node hands its parent """
+    stack = [[tr.root, 0.00, 0, list(tr.root.get_children()), 0, 0.00, None, 0.00]]
+    result = None
+    while len(stack) > 0:
+        frame = stack[-1]
+        (current, y_pos, depth, children, i, top, upper, lower) = frame
+        if not result is None:
+            (total_height, middle_height) = result
+            result = None
+            segments.append((x(depth), y_pos + top + middle_height, x(depth + 1), y_pos + top + middle_height))
             if (upper == None):
                 upper = top + middle_height
             lower = max(lower, top + middle_height)
             top += total_height
-        else:
+            i += 1
+        while i < len(children) and not children[i].has_children():
             if (upper == None):
                 upper = top
-            if facing_right:
-                ct.move_to(x_pos + (branch_length * depth), y_pos + top)
-                ct.line_to(x_pos + (branch_length * max_depth), y_pos + top )
-            else:
-                ct.move_to(x_pos + (branch_length * (max_depth-depth)), y_pos + top)
-                ct.line_to(x_pos + 0, y_pos + top )
-            ct.stroke()
+            segments.append((x(depth), y_pos + top, x(max_depth) if facing_right else 0, y_pos + top))
             lower = max(lower, top)
             top += height
-    if facing_right:
-        ct.move_to(x_pos + (branch_length * depth), y_pos + upper)
-        ct.line_to(x_pos  + (branch_length * depth), y_pos + lower)
-    else:
-        ct.move_to(x_pos + (branch_length * (max_depth-depth)), y_pos + upper)
-        ct.line_to(x_pos  + (branch_length * (max_depth-depth)), y_pos + lower)
+            i += 1
+        if i < len(children):
+            frame[4:] = [i, top, upper, lower]
+            c = children[i]
+            stack.append([c, y_pos + top, depth + 1, list(c.get_children()), 0, 0.00, None, 0.00])
+            continue
+        segments.append((x(depth), y_pos + upper, x(depth), y_pos + lower))
+        stack.pop()
+        result = (top, upper + ((lower - upper)/2.00))
+    return segments
+
+def draw_tree(ct, layout, x_pos):
+    ct.set_source_rgb(0, 0, 0)
+    ct.move_to(x_pos, 0)
+    ct.show_text(layout.title)
+    vert = layout.height
+    for l in layout.leaves:
+        ct.move_to(x_pos, vert)
+        ct.show_text(l)
+        vert += layout.height
+    return layout.widest
+
+def draw_lines(ct, left, right, x1, x2):
+    ct.set_source_rgba(0, 0, 0, line_darkness)
+    height = left.height
+    t = right.index
+    i = 1
+    for l in left.leaves:
+        p = t.get(l)
+        if not p is None:
+            ct.move_to(x1, height * i - (height / 3))
+            ct.line_to(x2, height * (p + 1) - (height / 3))
+            ct.stroke()
+        i += 1
+
+def draw_branches(ct, layout, x_pos, y_pos, facing_right = True):
+    """ Draw the branches of a laid out tree, all stroked at once """
+    for (x1, y1, x2, y2) in layout.branches[facing_right]:
+        ct.move_to(x_pos + x1, y_pos + y1)
+        ct.line_to(x_pos + x2, y_pos + y2)
     ct.stroke()
-    if current == tr.root:
-        return (max_depth+1) * branch_length
+    return layout.branch_width
+
+""" Estimated advance widths, in ems, of the characters of a serif font such as Georgia;
+every other character counts as g_default_width """
+g_char_widths = {}
+for (chars, w) in [("il.,:;'!|`", 0.28), ("fjrtI()[]{}-\"/", 0.36), ("sJ", 0.45),
+    ("abcdeghknopquvxyz0123456789_?*$", 0.56), ("FLPSTZ", 0.62), ("ABCEKRVXY&", 0.7),
+    ("DGHNOQU#", 0.76), ("mwMW%@", 0.88)]:
+    for c in chars:
+        g_char_widths[c] = w
+g_default_width = 0.6
+
+def estimated_width(text, size=font_size):
+    """ The estimated width of text set at the given font size """
+    return size * sum(g_char_widths.get(c, g_default_width) for c in text)
+
+def number(x):
+    """ A coordinate, written as short as two decimals allow """
+    s = "%.2f" % x
+    if '.' in s:
+        s = s.rstrip('0').rstrip('.')
+    if s == '-0':
+        s = '0'
+    return s
+
+class svg_writer:
+    """ svg_writer: the subset of a cairo context this module draws with, writing SVG
+         straight to a file instead of building the drawing in memory. Consecutive strokes
+         in the same colour are collected into a single path element, which is only written
+         out when the colour changes, text is drawn or the drawing is finished. Text extents
+         are estimated with estimated_width, so no font is ever loaded.
+    """
+    def __init__(self, f, width, height):
+        self.f = f
+        self.dx = 0
+        self.dy = 0
+        self.color = (0, 0, 0, 1)
+        self.point = None
+        self.pending = []
+        self.path = []
+        self.face = font_face
+        self.size = font_size
+        self.group = False
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<svg xmlns="http://www.w3.org/2000/svg" width="' + number(width) + '" height="' +
+            number(height) + '" viewBox="0 0 ' + number(width) + ' ' + number(height) + '">\n')
+
+    def translate(self, x, y):
+        self.dx += x
+        self.dy += y
+
+    def select_font_face(self, face, *style):
+        self.close_group()
+        self.face = face
+
+    def set_font_size(self, size):
+        self.close_group()
+        self.size = size
+
+    def set_source_rgb(self, r, g, b):
+        self.set_source_rgba(r, g, b, 1)
+
+    def set_source_rgba(self, r, g, b, a):
+        if (r, g, b, a) != self.color:
+            self.flush()
+            self.color = (r, g, b, a)
+
+    def paint(self, kind):
+        """ The attributes giving the current source as the colour of kind ('fill' or 'stroke') """
+        (r, g, b, a) = self.color
+        attributes = ' ' + kind + '="#%02x%02x%02x"' % tuple(int(round(255 * v)) for v in (r, g, b))
+        if a != 1:
+            attributes += ' ' + kind + '-opacity="' + number(a) + '"'
+        return attributes
+
+    def text_extents(self, text):
+        w = estimated_width(text, self.size)
+        return (0, -0.72 * self.size, w, 0.95 * self.size, w, 0)
+
+    def move_to(self, x, y):
+        self.point = (x + self.dx, y + self.dy)
+
+    def line_to(self, x, y):
+        if not self.point is None:
+            self.pending.append('M' + number(self.point[0]) + ' ' + number(self.point[1]))
+        self.point = (x + self.dx, y + self.dy)
+        self.pending.append('L' + number(self.point[0]) + ' ' + number(self.point[1]))
+        self.point = None
+
+    def stroke(self):
+        self.path.extend(self.pending)
+        self.pending = []
+        self.point = None
+
+    def flush(self):
+        """ Write out the strokes collected so far as one path element """
+        if len(self.path) > 0:
+            self.open_group()
+            self.f.write('<path fill="none" stroke-width="2"' + self.paint('stroke') +
+                ' d="' + ''.join(self.path) + '"/>\n')
+            self.path = []
+
+    def open_group(self):
+        if not self.group:
+            self.f.write('<g font-family=' + quoteattr(self.face) + ' font-size="' +
+                number(self.size) + '">\n')
+            self.group = True
+
+    def close_group(self):
+        self.flush()
+        if self.group:
+            self.f.write('</g>\n')
+            self.group = False
+
+    def show_text(self, text):
+        self.flush()
+        self.open_group()
+        (x, y) = self.point
+        self.f.write('<text x="' + number(x) + '" y="' + number(y) + '"' +
+            ('' if self.color == (0, 0, 0, 1) else self.paint('fill')) +
+            '>' + escape(text) + '</text>\n')
+        self.point = (x + estimated_width(text, self.size), y)
+
+    def finish(self):
+        self.close_group()
+        self.f.write('</svg>\n')
+
+def new_context(f, width, height, backend=None):
+    """ A drawing context (cairo, or svg_writer with backend 'svg') writing an SVG of the given
+    size into file f, set up as every drawing of this module expects, and the surface to finish """
+    if backend is None:
+        backend = 'svg' if cairo is None else 'cairo'
+    if backend == 'svg':
+        surf = svg_writer(f, width, height)
+        ct = surf
     else:
-        return (top, upper + ((lower - upper)/2.00))
+        surf = cairo.SVGSurface(f, width, height)
+        ct = cairo.Context(surf)
+    ct.translate(10,16)
+    ct.set_source_rgb(0.0, 0.0, 0.0)
+    if backend == 'svg':
+        ct.select_font_face(font_face)
+    else:
+        ct.select_font_face(font_face, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+    ct.set_font_size(font_size)
+    return (surf, ct)
+
+def pair_width(left, right):
+    """ The width of the drawing of a pair of laid out trees """
+    return left.branch_width + line_gap + left.widest + line_gap + line_region_width + line_gap + \
+        right.widest + line_gap + right.branch_width + 20
+
+def render_pair(job):
+    """ Draw one pair of laid out trees, with their branches, into its own SVG file """
+    (left, right, filename, backend) = job
+    height = left.height
+    with open(filename, 'w') as f:
+        (surf, ct) = new_context(f, pair_width(left, right),
+            max(len(left.leaves), len(right.leaves)) * height + height + 20, backend)
+        left_x = draw_branches(ct, left, 0, height - height / 3, True)
+        w = draw_tree(ct, left, left_x + line_gap)
+        draw_lines(ct, left, right, left_x + w + line_gap, left_x + w + line_gap + line_region_width)
+        left_x += w + line_gap + line_region_width + line_gap
+        w = draw_tree(ct, right, left_x)
+        draw_branches(ct, right, left_x + w + line_gap, height - height / 3, False)
+        surf.finish()
+    return filename
+
+def render_pairs(layouts, jobs=1, backend=None):
+    """ Render every combination of the laid out trees to 'tree1:tree2.svg', on a pool of
+    _jobs_ processes """
+    work = [(left, right, left.name + ':' + right.name + '.svg', backend)
+        for (left, right) in itertools.combinations(layouts, 2)]
+    if jobs > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(jobs)
+        """ get() with a timeout keeps the pool responsive to ctrl-c """
+        files = pool.map_async(render_pair, work, 1).get(2**31)
+        pool.close()
+        pool.join()
+        return files
+    return map(render_pair, work)
 
 if __name__=='__main__':
     """
     Loop over all files, reading in all available trees.
     """
-    for line in fileinput.input():
-        #line = line.trim()
-        if line[0:4] == 'tree':
-            tr = tree(line)
+    parser = argparse.ArgumentParser(description = 'Render tanglegrams of all combinations of trees.')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='number of processes rendering the per-pair files')
+    parser.add_argument('--backend', choices=['cairo', 'svg'], default='svg' if cairo is None else 'cairo',
+        help='draw with cairo, or write the SVG directly (smaller files, no dependencies)')
+    parser.add_argument('infiles', nargs='+')
+    args = parser.parse_args()
+    if args.backend == 'cairo' and cairo is None:
+        raise SystemExit("cairo is not installed, use --backend svg")
+    for filename in args.infiles:
+        for tr in read_trees(filename, tree):
             if first_tree == None:
                 first_tree = tr.name
             trees[tr.name] = tr
@@ -166,19 +404,17 @@ if __name__=='__main__':
     combos = list(itertools.combinations(tree_list,2))
 
     f = open('output.svg', 'w')
-    surf = cairo.SVGSurface(f, len(combos) * (120 + line_gap+ line_region_width) * 2, len(tr.leaves()) * 40)
-    ct = cairo.Context(surf)
-    ct.translate(10,16)
-    ct.set_source_rgb(0.0, 0.0, 0.0)
-    ct.select_font_face("Georgia", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
-    ct.set_font_size(12)
+    (surf, ct) = new_context(f, len(combos) * (120 + line_gap+ line_region_width) * 2,
+        max(len(tr.leaves()) for tr in tree_list) * 40, args.backend)
     
     x_bearing, y_bearing, width, height = ct.text_extents("Tygp")[:4]
     height = height * 1.25
+    metrics = text_metrics(ct)
+    layouts = dict((tr.name, tree_layout(tr, metrics, height)) for tr in tree_list)
     left_x = 0
     left_tree = tree_list[0]
 
-    w = draw_tree(ct, left_tree, 0, height)
+    w = draw_tree(ct, layouts[left_tree.name], 0)
 
     while len(combos) > 0:
         valid = list(x for x in combos if left_tree in x)
@@ -189,49 +425,17 @@ if __name__=='__main__':
             else:
                 right_tree = valid[0][0]
             """ We have a left tree and a right tree - draw the right tree, and the links """
-            draw_lines(ct, left_tree, right_tree, left_x + w + line_gap, left_x + w + line_gap + line_region_width, height)
+            draw_lines(ct, layouts[left_tree.name], layouts[right_tree.name], left_x + w + line_gap, left_x + w + line_gap + line_region_width)
             left_x += w + line_gap + line_region_width + line_gap
-            w = draw_tree(ct, right_tree, left_x, height)
+            w = draw_tree(ct, layouts[right_tree.name], left_x)
             left_tree = right_tree
             combos.remove(valid[0])
         else:
             left_x += w + line_gap
             left_tree = combos[0][0]
-            w = draw_tree(ct, left_tree, left_x, height)
+            w = draw_tree(ct, layouts[left_tree.name], left_x)
     surf.finish()
     #time.sleep(5)
     f.close()
-            
-    combos = list(itertools.combinations(tree_list,2))
-    while len(combos) > 0:
-        left_tree = combos[0][0]
-        right_tree = combos[0][1]
-
-        f = open(left_tree.name + ':' + right_tree.name + '.svg', 'w')
-        surf = cairo.SVGSurface(f, left_tree.max_depth() * 20 + right_tree.max_depth() * 20 + len(combos) * (120 + line_gap+ line_region_width) * 2, len(tr.leaves()) * 40)
-        ct = cairo.Context(surf)
-        ct.translate(10,16)
-        ct.set_source_rgb(0.0, 0.0, 0.0)
-        ct.select_font_face("Georgia", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
-        ct.set_font_size(12)
-        
-        x_bearing, y_bearing, width, height = ct.text_extents("Tygp")[:4]
-        height = height * 1.25
-        left_x = 0
-        
-        """ We have a left tree and a right tree - draw the right tree, and the links """
-        w = draw_branches(ct, left_tree, 0, height - height / 3, height, 20, True)
-        left_x = w
-        w = draw_tree(ct, left_tree, left_x + line_gap, height)
-        draw_lines(ct, left_tree, right_tree, left_x + w + line_gap, left_x + w + line_gap + line_region_width, height)
-        left_x += w + line_gap + line_region_width + line_gap
-        w = draw_tree(ct, right_tree, left_x, height)
-        w = draw_branches(ct, right_tree, left_x + w + line_gap, height - height / 3, height, 20, False)
-        combos.remove(combos[0])
-        surf.finish()
-        #time.sleep(5)
-        f.close()
-            
 
-                    
-                
+    render_pairs([layouts[tr.name] for tr in tree_list], args.jobs, args.backend)
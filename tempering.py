@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+"""
+tempering.py - Copyright (c) 2012, Howard C. Shaw III
+Licensed under the GNU GPL v3
+
+tempering.py [filename] ...
+
+Pass any number of filenames, tempering will extract all trees, and optimize them all simultaneously
+by parallel tempering (replica exchange), minimizing on all combinations of trees.
+
+Several replicas of the trees are twisted independently, each at its own temperature, and accept
+a worse result with the Metropolis probability exp(-increase / temperature), so that the hotter
+replicas can climb out of the local minima the greedy process_trees gets stuck in. Every round,
+neighbouring temperatures try to exchange their replicas, which lets good layouts found while
+hot be refined by the colder replicas. With --jobs J > 1 the replicas are spread over J
+processes, and only temperatures, scores and twist vectors are passed between processes.
+
+The best result seen by any replica is written to result.dat (or the -o file).
+"""
+
+from detangle import read_trees, scorer, write, g_objective, g_skip_first_tree, g_output_filename, \
+    g_time_limit, add_objective_arguments, objective_options
+import random
+import math
+import time
+import copy
+import argparse
+import multiprocessing
+
+""" Tweak these values to change behavior:
+
+Replicas = the number of replicas, one per temperature
+Minimum Temperature, Maximum Temperature = the temperatures of the coldest and hottest replica,
+the others are spaced geometrically between them
+Rounds = the number of exchange rounds
+Sweeps = the number of sweeps (one move per tree) each replica makes between exchanges
+Moves = the number of random twists per move
+"""
+
+g_replicas = 8
+g_min_temperature = 0.5
+g_max_temperature = 50.0
+g_rounds = 200
+g_sweeps = 10
+g_moves = 2
+
+class replica:
+    """ replica: one copy of the trees, twisted by Metropolis moves at a given temperature.
+         It keeps its own scorer and random generator, and remembers the best twists seen.
+    """
+    def __init__(self, tree_list, seed, objective=g_objective, skip_first_tree=g_skip_first_tree,
+        moves=g_moves, weights=None, pair_weights=None):
+        self.tree_list = tree_list
+        self.trees = dict((tr.name, tr) for tr in tree_list)
+        self.twists = dict((tr.name, tr.get_twists()) for tr in tree_list)
+        self.sizes = dict((tr.name, tr.twist_sizes()) for tr in tree_list)
+        self.names = [tr.name for tr in tree_list if len(self.twists[tr.name]) > 0]
+        if skip_first_tree and len(tree_list) > 0:
+            self.names = [x for x in self.names if x != tree_list[0].name]
+        self.random = random.Random(seed)
+        self.moves = moves
+        self.scorer = scorer(self.trees, objective, weights=weights, pair_weights=pair_weights)
+        self.score = self.scorer.total()
+        self.best = self.score
+        self.best_twists = dict(self.twists)
+
+    def run(self, temperature, sweeps):
+        """ Make _sweeps_ passes over the trees at the given temperature,
+        and return the current score, the best score, and the moves accepted and tried """
+        rnd = self.random
+        accepted = 0
+        tried = 0
+        for s in range(0, sweeps):
+            for name in self.names:
+                t = list(self.twists[name])
+                size = self.sizes[name]
+                for j in range(0, self.moves):
+                    k = rnd.randint(0,len(t)-1)
+                    t[k] = (t[k] + 1) % size[k]
+                tried += 1
+                if t == self.twists[name]:
+                    """ The twists cancel out: a move to the same layout, always accepted """
+                    accepted += 1
+                    continue
+                span = self.trees[name].apply_twists(t)
+                cur = self.scorer.update(name, span)
+                delta = cur - self.score
+                if delta <= 0 or rnd.random() < math.exp(-delta / temperature):
+                    self.scorer.accept()
+                    self.twists[name] = t
+                    self.score = cur
+                    accepted += 1
+                    if cur < self.best:
+                        self.best = cur
+                        self.best_twists = dict(self.twists)
+                else:
+                    self.trees[name].apply_twists(self.twists[name])
+                    self.scorer.reject()
+        return (self.score, self.best, accepted, tried)
+
+    def get_best(self):
+        return (self.best, [self.best_twists[tr.name] for tr in self.tree_list])
+
+def replica_main(conn, tree_list, seeds, options):
+    """ The loop run by a replica process: it owns the trees of its replicas (one copy each),
+    and only receives temperatures and sends back scores and twists, tagged with the
+    number of the replica """
+    reps = dict((i, replica(copy.deepcopy(tree_list), seed, **options)) for (i, seed) in seeds)
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'run':
+            conn.send((msg[1], reps[msg[1]].run(msg[2], msg[3])))
+        elif msg[0] == 'best':
+            conn.send((msg[1], reps[msg[1]].get_best()))
+        else:
+            break
+    conn.close()
+
+class replica_process:
+    """ replica_process: a process running several replicas, one after the other. Replies
+         are kept by replica number until asked for, so they can be collected in any order.
+    """
+    def __init__(self, tree_list, seeds, options):
+        (self.conn, child) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=replica_main, args=(child, tree_list, seeds, options))
+        self.process.daemon = True
+        self.process.start()
+        self.replies = {}
+
+    def send(self, msg):
+        self.conn.send(msg)
+
+    def receive(self, i):
+        while not i in self.replies:
+            (j, reply) = self.conn.recv()
+            self.replies[j] = reply
+        return self.replies.pop(i)
+
+    def stop(self):
+        self.conn.send(('stop',))
+        self.process.join()
+
+class remote_replica:
+    """ remote_replica: a replica run by a replica_process, with the same interface as replica,
+         split into start_run/finish_run so that all replicas can run at once.
+    """
+    def __init__(self, process, i):
+        self.process = process
+        self.i = i
+
+    def start_run(self, temperature, sweeps):
+        self.process.send(('run', self.i, temperature, sweeps))
+
+    def finish_run(self):
+        return self.process.receive(self.i)
+
+    def get_best(self):
+        self.process.send(('best', self.i))
+        return self.process.receive(self.i)
+
+    def stop(self):
+        pass
+
+class local_replica(replica):
+    """ local_replica: a replica run in this process, with the remote_replica interface """
+    def __init__(self, tree_list, seed, options):
+        replica.__init__(self, tree_list, seed, **options)
+
+    def start_run(self, temperature, sweeps):
+        self.result = self.run(temperature, sweeps)
+
+    def finish_run(self):
+        return self.result
+
+    def stop(self):
+        pass
+
+def temperature_ladder(replicas=g_replicas, min_temperature=g_min_temperature,
+    max_temperature=g_max_temperature):
+    """ Geometrically spaced temperatures, coldest first """
+    if replicas == 1:
+        return [min_temperature]
+    ratio = (max_temperature / min_temperature) ** (1.0 / (replicas - 1))
+    return [min_temperature * ratio ** i for i in range(0, replicas)]
+
+def parallel_tempering(tree_list, temperatures=None, rounds=g_rounds, sweeps=g_sweeps,
+    jobs=1, seed=None, output_filename=g_output_filename, verbose=True, time_limit=g_time_limit,
+    **options):
+    """Run one replica of the trees per temperature for _rounds_ rounds of _sweeps_
+    sweeps each, attempting exchanges between neighbouring temperatures after every
+    round (even pairs on even rounds, odd pairs on odd rounds). With jobs > 1, the
+    replicas are spread over that many processes (at most one per replica); every
+    replica gets the same seed either way. options are passed to replica (objective,
+    skip_first_tree, moves, weights, pair_weights). The trees are left with the best twists found by any
+    replica, which are written to output_filename. With time_limit, no round is started
+    after that many seconds. Returns the best value.
+    """
+    if temperatures is None:
+        temperatures = temperature_ladder()
+    deadline = None if time_limit is None else time.time() + time_limit
+    if seed is None:
+        seed = random.randint(0, 2**31 - 1)
+    rnd = random.Random(seed)
+    processes = []
+    if jobs > 1:
+        processes = [replica_process(tree_list,
+            [(i, seed + 1 + i) for i in range(j, len(temperatures), jobs)], options)
+            for j in range(0, min(jobs, len(temperatures)))]
+        replicas = [remote_replica(processes[i % len(processes)], i) for i in range(0, len(temperatures))]
+    else:
+        """ Local replicas must not share the tree objects """
+        replicas = [local_replica(copy.deepcopy(tree_list), seed + 1 + i, options)
+            for i in range(0, len(temperatures))]
+    """ ladder[k] is the replica currently at temperatures[k] """
+    ladder = range(0, len(replicas))
+    swaps = 0
+    try:
+        for r in range(0, rounds):
+            if not deadline is None and time.time() >= deadline:
+                break
+            for k in range(0, len(ladder)):
+                replicas[ladder[k]].start_run(temperatures[k], sweeps)
+            results = [None] * len(replicas)
+            for k in range(0, len(ladder)):
+                results[ladder[k]] = replicas[ladder[k]].finish_run()
+            for k in range(r % 2, len(ladder) - 1, 2):
+                e1 = results[ladder[k]][0]
+                e2 = results[ladder[k+1]][0]
+                x = (1.0 / temperatures[k] - 1.0 / temperatures[k+1]) * (e1 - e2)
+                if x >= 0 or rnd.random() < math.exp(x):
+                    (ladder[k], ladder[k+1]) = (ladder[k+1], ladder[k])
+                    swaps += 1
+            if verbose:
+                print "Round " + str(r) + ", Optimize " + str(min(res[1] for res in results)) + ", Current " + \
+                    ", ".join(str(results[i][0]) for i in ladder) + ", Swaps " + str(swaps)
+        (best, twists) = min(rep.get_best() for rep in replicas)
+    finally:
+        for rep in replicas:
+            rep.stop()
+        for process in processes:
+            process.stop()
+    for (tr, t) in zip(tree_list, twists):
+        tr.apply_twists(t)
+    if not output_filename is None:
+        write(output_filename, tree_list)
+    return best
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description = 'Minimize tangling across multiple trees by parallel tempering.')
+    parser.add_argument('-o', '--output-filename', dest='output_filename', default=g_output_filename)
+    parser.add_argument('--replicas', type=int, default=g_replicas)
+    parser.add_argument('--min-temperature', type=float, default=g_min_temperature)
+    parser.add_argument('--max-temperature', type=float, default=g_max_temperature)
+    parser.add_argument('--rounds', type=int, default=g_rounds)
+    parser.add_argument('--sweeps', type=int, default=g_sweeps)
+    parser.add_argument('--moves', type=int, default=g_moves)
+    parser.add_argument('--jobs', type=int, default=1,
+        help='number of processes to spread the replicas over')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--time-limit', type=float, default=g_time_limit, metavar='SECONDS',
+        help='start no round after SECONDS, keeping the best layout found')
+    add_objective_arguments(parser)
+    parser.add_argument('infiles', nargs='+')
+    args = parser.parse_args()
+    tree_list = []
+    for filename in args.infiles:
+        tree_list.extend(read_trees(filename))
+    best = parallel_tempering(tree_list,
+        temperature_ladder(args.replicas, args.min_temperature, args.max_temperature),
+        args.rounds, args.sweeps, args.jobs, args.seed, args.output_filename, time_limit=args.time_limit,
+        moves=args.moves, **objective_options(args))
+    print "Optimize " + str(best)
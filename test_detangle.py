@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+"""
+test_detangle.py - Copyright (c) 2012, Howard C. Shaw III
+Licensed under the GNU GPL v3
+
+Checks of the tree reader on the bundled example files, and of the incremental scorer
+(pure Python and NumPy) against minimize_this: python test_detangle.py
+"""
+
+import detangle
+from detangle import read_trees, parse_tree_statement, compact_tree, tree, scorer, minimize_this
+from benchmark import synthetic_nexus
+import os
+import random
+import unittest
+
+g_directory = os.path.dirname(os.path.abspath(__file__))
+
+class read_trees_test(unittest.TestCase):
+    def test_translate(self):
+        """ godef.tre has a newline and tabs after Translate, as PAUP writes it """
+        for factory in (compact_tree, tree):
+            tree_list = list(read_trees(os.path.join(g_directory, 'godef.tre'), factory))
+            self.assertEqual([tr.name for tr in tree_list], ['PAUP1', 'PAUP2', 'PAUP3'])
+            leaves = list(tree_list[0].leaves())
+            self.assertEqual(len(leaves), 21)
+            self.assertEqual(leaves[0], 'Bactrosaurus')
+            self.assertFalse(any(x.isdigit() for x in leaves))
+
+    def test_tree_name(self):
+        self.assertEqual(parse_tree_statement('tree\tPAUP1 = [&U] (a,b)')[0], 'PAUP1')
+        self.assertEqual(parse_tree_statement('TREE\n* best=(a,b)')[0], 'best')
+
+class scorer_test(unittest.TestCase):
+    """ Random moves, accepted or rejected, must leave the scorer with the value minimize_this
+    computes from scratch in pure Python, on trees with partial overlap and multifurcations """
+    def check(self, use_numpy, objective, weights=None, pair_weights=None, factory=None):
+        lines = synthetic_nexus(taxa=30, trees=4, overlap=0.8, multifurcation=0.3, seed=3)
+        tree_list = list(read_trees(lines, factory))
+        trees = dict((tr.name, tr) for tr in tree_list)
+        names = sorted(trees.keys())
+        rnd = random.Random(5)
+        sc = scorer(trees, objective, use_numpy, weights, pair_weights)
+        saved = detangle.g_use_numpy
+        detangle.g_use_numpy = False
+        try:
+            self.assertEqual(sc.total(), minimize_this(trees, objective, weights, pair_weights))
+            for i in range(0, 150):
+                name = rnd.choice(names)
+                tr = trees[name]
+                old = tr.get_twists()
+                t = list(old)
+                sizes = tr.twist_sizes()
+                for j in range(0, rnd.choice([1, 2, 5])):
+                    k = rnd.randint(0, len(t) - 1)
+                    t[k] = (t[k] + 1) % sizes[k]
+                cur = sc.update(name, tr.apply_twists(t))
+                self.assertEqual(cur, minimize_this(trees, objective, weights, pair_weights))
+                if rnd.random() < 0.5:
+                    sc.accept()
+                else:
+                    tr.apply_twists(old)
+                    sc.reject()
+                    self.assertEqual(sc.total(), minimize_this(trees, objective, weights, pair_weights))
+        finally:
+            detangle.g_use_numpy = saved
+
+    def test_python(self):
+        self.check(False, 'tangle')
+        self.check(False, 'crossing', {'tangle': 1}, {('T0', 'T1'): 2, ('T2', '*'): 0.5})
+        self.check(False, 'tangle', factory=tree)
+
+    @unittest.skipIf(detangle.numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        self.check(True, 'tangle')
+        self.check(True, 'crossing', {'tangle': 1}, {('T0', 'T1'): 2, ('T2', '*'): 0.5})
+
+if __name__=='__main__':
+    unittest.main()